@@ -0,0 +1,203 @@
+import time
+import logging
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from config import CLIENT_SCHEDULER
+from . import multi_clients, work_loads
+
+
+class ClientStats:
+    # an error counts half as much after this many seconds, so a bad burst doesn't penalise a client forever
+    error_half_life = 60.0
+    error_weight = 0.2
+
+    def __init__(self):
+        self.outstanding = 0
+        self.bytes = 0
+        self.throughput = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.flood_waits = 0
+        self.cooldown_until = 0.0
+        self.recent_errors = 0.0
+        self.errors_updated = time.time()
+
+    @property
+    def error_rate(self) -> float:
+        """Share of recent chunks that failed, an EWMA that also decays while the client is idle."""
+        return self.recent_errors * 0.5 ** ((time.time() - self.errors_updated) / self.error_half_life)
+
+    def record_outcome(self, failed: bool) -> None:
+        rate = self.error_rate
+        self.recent_errors = rate + self.error_weight * ((1.0 if failed else 0.0) - rate)
+        self.errors_updated = time.time()
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "outstanding": self.outstanding,
+            "bytes": self.bytes,
+            "throughput": round(self.throughput),
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate, 3),
+            "flood_waits": self.flood_waits,
+            "cooldown": max(0, round(self.cooldown_until - time.time())),
+        }
+
+
+class ClientScheduler:
+    """Picks the client that serves the next stream.
+    The base class only tracks the live signals (active streams, in-flight chunks,
+    throughput, errors and FloodWait cooldowns) reported by ByteStreamer, and keeps
+    a counter of every decision with the reason it was made.
+    Subclasses implement score(), the client with the lowest score wins.
+    """
+
+    name = "base"
+    ewma_weight = 0.2
+    max_files = 10000
+    # a client has affinity for a DC it downloaded a chunk from within this many seconds
+    affinity_window = 300
+
+    def __init__(self):
+        self.stats: Dict[int, ClientStats] = {}
+        # LRU of message id to the DC its file lives on, for the most recently streamed files
+        self.file_dcs: "OrderedDict[int, int]" = OrderedDict()
+        # (client index, DC id) to the last time the client got a chunk from that DC
+        self.dc_served: Dict[Tuple[int, int], float] = {}
+        self.decisions = Counter()
+        self.last_decision: Dict[str, object] = {}
+
+    def get_stats(self, index: int) -> ClientStats:
+        if index not in self.stats:
+            self.stats[index] = ClientStats()
+        return self.stats[index]
+
+    # ---- signals reported by the streaming layer ----
+    def chunk_started(self, index: int) -> None:
+        stats = self.get_stats(index)
+        stats.outstanding += 1
+        stats.requests += 1
+
+    def chunk_finished(self, index: int, size: int, elapsed: float, dc_id: Optional[int] = None) -> None:
+        stats = self.get_stats(index)
+        if dc_id is not None:
+            self.dc_served[(index, dc_id)] = time.time()
+        stats.outstanding -= 1
+        stats.bytes += size
+        stats.record_outcome(failed=False)
+        if elapsed > 0:
+            rate = size / elapsed
+            stats.throughput += self.ewma_weight * (rate - stats.throughput)
+
+    def chunk_failed(self, index: int) -> None:
+        stats = self.get_stats(index)
+        stats.outstanding -= 1
+        stats.errors += 1
+        stats.record_outcome(failed=True)
+
+    def chunk_cancelled(self, index: int) -> None:
+        stats = self.get_stats(index)
+        stats.outstanding -= 1
+        stats.requests -= 1
+
+    def flood_wait(self, index: int, seconds: int) -> None:
+        stats = self.get_stats(index)
+        stats.flood_waits += 1
+        stats.cooldown_until = max(stats.cooldown_until, time.time() + seconds)
+        logging.warning(f"Client {index} is cooling down for {seconds}s after a FloodWait")
+
+    def remember_dc(self, id: int, dc_id: int) -> None:
+        self.file_dcs[id] = dc_id
+        self.file_dcs.move_to_end(id)
+        while len(self.file_dcs) > self.max_files:
+            self.file_dcs.popitem(last=False)
+
+    def relative_throughput(self, index: int) -> float:
+        """The client's live throughput as a share of the fastest client's, 0 until anything was measured."""
+        fastest = max((self.get_stats(i).throughput for i in multi_clients), default=0.0)
+        return self.get_stats(index).throughput / fastest if fastest > 0 else 0.0
+
+    # ---- decision ----
+    def score(self, index: int, dc_id: Optional[int]) -> float:
+        raise NotImplementedError
+
+    def choose(self, id: Optional[int] = None, exclude: Iterable[int] = ()) -> int:
+        """
+        Returns the index of the client in multi_clients that should serve the message.
+        Clients in `exclude` (the ones a download already failed on) are only used if nothing else is left.
+        """
+        dc_id = self.file_dcs.get(id)
+        now = time.time()
+        clients = [i for i in multi_clients if i not in exclude] or list(multi_clients)
+        candidates = [i for i in clients if self.get_stats(i).cooldown_until <= now]
+        if candidates:
+            index = min(candidates, key=lambda i: (self.score(i, dc_id), -self.get_stats(i).throughput))
+            # affinity only decided anything if some other candidate lacked it
+            affine = [self.has_affinity(i, dc_id) for i in candidates]
+            reason = "affinity" if self.has_affinity(index, dc_id) and not all(affine) else "least_loaded"
+        else:
+            # every client is cooling down, use the one that gets back first
+            index = min(clients, key=lambda i: self.get_stats(i).cooldown_until)
+            reason = "all_cooling_down"
+        self.decisions[(index, reason)] += 1
+        self.last_decision = {"client": index, "reason": reason, "dc_id": dc_id}
+        logging.debug(f"Scheduler picked client {index} ({reason}, dc {dc_id})")
+        return index
+
+    def has_affinity(self, index: int, dc_id: Optional[int]) -> bool:
+        """
+        Whether the client recently served chunks from the DC. Holding a media session isn't enough,
+        with PREWARM_MEDIA_SESSIONS every client holds one for every DC.
+        """
+        served = self.dc_served.get((index, dc_id))
+        return served is not None and time.time() - served <= self.affinity_window
+
+    def as_dict(self) -> Dict[str, object]:
+        clients = {}
+        for index in multi_clients:
+            clients[index] = {"work_load": work_loads.get(index, 0), **self.get_stats(index).as_dict()}
+        return {
+            "scheduler": self.name,
+            "clients": clients,
+            "decisions": {f"{i}:{reason}": n for (i, reason), n in self.decisions.items()},
+            "last_decision": self.last_decision,
+        }
+
+
+class LeastLoadedScheduler(ClientScheduler):
+    """Same behaviour as the old min(work_loads), plus cooldowns."""
+
+    name = "least_loaded"
+
+    def score(self, index: int, dc_id: Optional[int]) -> float:
+        return work_loads.get(index, 0)
+
+
+class AffinityScheduler(ClientScheduler):
+    """Least loaded client, preferring fast clients and clients that recently downloaded
+    from the DC of the file, and penalising clients with a high recent error rate."""
+
+    name = "affinity"
+    affinity_bonus = 0.5
+    chunk_weight = 0.25
+    error_weight = 4.0
+    throughput_weight = 1.0
+
+    def score(self, index: int, dc_id: Optional[int]) -> float:
+        stats = self.get_stats(index)
+        score = work_loads.get(index, 0)
+        score += self.chunk_weight * stats.outstanding
+        score += self.error_weight * stats.error_rate
+        score -= self.throughput_weight * self.relative_throughput(index)
+        if self.has_affinity(index, dc_id):
+            score -= self.affinity_bonus
+        return score
+
+
+SCHEDULERS = {
+    LeastLoadedScheduler.name: LeastLoadedScheduler,
+    AffinityScheduler.name: AffinityScheduler,
+}
+
+scheduler: ClientScheduler = SCHEDULERS.get(CLIENT_SCHEDULER, AffinityScheduler)()
@@ -1,8 +1,12 @@
 from aiohttp import web
 from .stream_routes import routes
+from ..utils.tracing import trace_middleware
+from ..utils.forwarded import forwarded_middleware
+from ..utils.chat_ingest import chat_ingest
 
 
 async def web_server():
-    web_app = web.Application(client_max_size=30000000)
+    web_app = web.Application(client_max_size=30000000, middlewares=[forwarded_middleware, trace_middleware])
     web_app.add_routes(routes)
+    web_app.on_cleanup.append(lambda app: chat_ingest.close())
     return web_app
@@ -2,5 +2,14 @@
 class InvalidHash(Exception):
     message = "Invalid hash"
 
+class LinkExpired(InvalidHash):
+    message = "This link has expired"
+
 class FIleNotFound(Exception):
-    message = "File not found"
\ No newline at end of file
+    message = "File not found"
+
+class RangeNotSatisfiable(Exception):
+    message = "416: Range not satisfiable"
+
+class TooManyStreams(Exception):
+    message = "Too many concurrent streams, try again later"
@@ -1,23 +1,35 @@
-import re
 import time
-import math
 import logging
 import secrets
 import mimetypes
 import os
-import asyncio
 import aiofiles
 
+from typing import Optional
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
-from TechVJ.bot import multi_clients, work_loads, StreamBot
-from TechVJ.server.exceptions import FIleNotFound, InvalidHash
+from TechVJ.bot import multi_clients, StreamBot
+from TechVJ.bot.scheduler import scheduler
+from TechVJ.server.exceptions import FIleNotFound, InvalidHash, RangeNotSatisfiable, TooManyStreams
 from TechVJ import StartTime, __version__
 from ..utils.time_format import get_readable_time
-from ..utils.custom_dl import ByteStreamer
+from ..utils.custom_dl import chunk_stats, get_streamer, plan_chunks, yield_striped_file
+from ..utils.chunk_cache import chunk_cache
+from ..utils.file_cache import file_cache
+from ..utils.http_range import etag_matches, parse_range_header
+from ..utils.bandwidth import shaper
+from ..utils.hls import build_playlist, segment_count, segment_range, supports_hls
+from ..utils import metrics
+from ..utils.tracing import tracer
+from ..utils.link_path import LINK_PATTERN, authorize, parse_link_path
+from ..utils.stream_token import link_query
+from ..utils.chat_ingest import chat_ingest
+from ..utils.media_proxy import media_resolver
 from TechVJ.utils.render_template import render_page, render_page_stream
-from config import MULTI_CLIENT
+from config import MULTI_CLIENT, STRIPED_DOWNLOAD, STREAM_WRITE_HIGH, STREAM_WRITE_LOW
 from plugins.dbusers import db
+from bson import ObjectId
+from bson.errors import InvalidId
 import json
 import os
 from datetime import datetime
@@ -25,9 +37,11 @@ from zoneinfo import ZoneInfo
 routes = web.RouteTableDef()
 
 # Websocket connections များကို သိမ်းဆည်းရန်
-active_sockets = set()
+active_sockets = chat_ingest.subscribers
 
 UPLOAD_DIR = "static/uploads"
+INBOX_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE = 50
 
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
@@ -36,39 +50,90 @@ if not os.path.exists(UPLOAD_DIR):
 def get_timestamp():
     return datetime.now(ZoneInfo("Asia/Yangon")).strftime("%Y-%m-%d %H:%M:%S")
 
+def inbox_cursor(conversations):
+    if len(conversations) < INBOX_PAGE_SIZE:
+        return None
+    last = conversations[-1]
+    return f"{last.get('last_update') or ''}|{last['_id']}"
+
+def parse_inbox_cursor(cursor):
+    last_update, _, _id = cursor.rpartition("|")
+    try:
+        return last_update, ObjectId(_id)
+    except InvalidId:
+        raise web.HTTPBadRequest(text="Invalid cursor")
+
+def json_response(data):
+    # ObjectIds and datetimes are sent as strings
+    return web.json_response(data, dumps=lambda d: json.dumps(d, default=str))
+
 
 @routes.get("/", allow_head=True)
 async def root_route_handler(request):
     return web.json_response({
         "server_status": "running",
         "uptime": get_readable_time(time.time() - StartTime),
-        "version": __version__
+        "version": __version__,
+        "chunk_cache": chunk_cache.stats(),
+        "file_cache": file_cache.stats(),
+        "chunk_sizes": {str(k): v for k, v in chunk_stats.items()},
+        "streams": shaper.stats(),
+        "chat_ingest": chat_ingest.stats(),
+        "media_proxy": media_resolver.stats(),
+        "clients": scheduler.as_dict()
     })
 
+def collect_metrics():
+    """Copies the counters kept by the scheduler, caches and shaper into the metrics registry."""
+    for index, stats in scheduler.as_dict()["clients"].items():
+        metrics.client_work_load.set(stats["work_load"], client=index)
+        metrics.client_throughput.set(stats["throughput"], client=index)
+        metrics.client_bytes.set(stats["bytes"], client=index)
+        metrics.client_requests.set(stats["requests"], client=index)
+        metrics.client_errors.set(stats["errors"], client=index)
+        metrics.client_flood_waits.set(stats["flood_waits"], client=index)
+    for name, stats in (("chunk", chunk_cache.stats()), ("metadata", file_cache.stats())):
+        lookups = stats["hits"] + stats["misses"]
+        metrics.cache_hits.set(stats["hits"], cache=name)
+        metrics.cache_misses.set(stats["misses"], cache=name)
+        metrics.cache_hit_ratio.set(round(stats["hits"] / lookups, 4) if lookups else 0, cache=name)
+    streams = shaper.stats()
+    metrics.active_streams.set(streams["active_streams"])
+    metrics.rejected_streams.set(streams["rejected"])
+    metrics.websocket_connections.set(len(active_sockets))
+
+
+@routes.get("/metrics")
+async def metrics_route_handler(request):
+    collect_metrics()
+    return web.Response(
+        body=metrics.render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
 @routes.get("/dashboard") # Dashboard Menu အတွက်
 @routes.get("/tgchat")
 async def tgchat_dashboard(request):
     try:
-        # chats array တစ်ခုလုံးကို ယူမှသာ reload လုပ်ရင် message အသစ်တွေကို စစ်နိုင်မှာပါ
-        # ဒါပေမယ့် data များမှာစိုးရင် chats ရဲ့ နောက်ဆုံး အစောင် ၂၀ လောက်ပဲ slice လုပ်ယူပါ
-        cursor = db.chat_col.find({}, {"user_id": 1, "user_name": 1, "chats": {"$slice": -20}})
-        users_list = await cursor.to_list(length=100)
+        # conversation summary တွေပဲ ယူမယ်၊ message တွေက chat_messages ထဲမှာ သီးသန့်ရှိတယ်
+        users_list = await db.get_inbox(INBOX_PAGE_SIZE)
         
         active_user_id = request.query.get('user_id')
         active_chat = None
         
         if active_user_id:
             user_id_int = int(active_user_id)
-            # Admin က ဝင်ကြည့်တဲ့အတွက် message အားလုံးကို ဖတ်ပြီးသားလုပ်မယ်
-            await db.chat_col.update_one(
-                {'user_id': user_id_int},
-                {'$set': {'chats.$[].is_read': True}}
-            )
-            active_chat = await db.chat_col.find_one({'user_id': user_id_int})
+            # Admin က ဝင်ကြည့်တဲ့အတွက် read cursor ကို နောက်ဆုံး message အထိ ရွှေ့မယ်
+            await db.mark_read(user_id_int)
+            active_chat = await db.chat_col.find_one({'user_id': user_id_int}, {"last_message": 0})
+            if active_chat:
+                active_chat["chats"] = await db.get_user_chats(user_id_int, MESSAGE_PAGE_SIZE)
 
         context = {
             "users": users_list,
+            "next_cursor": inbox_cursor(users_list),
             "active_chat": active_chat,
+            "has_older_messages": bool(active_chat) and len(active_chat["chats"]) == MESSAGE_PAGE_SIZE,
             "active_page": "tg_chat",
             "now": datetime.now(ZoneInfo("Asia/Yangon")).strftime("%Y-%m-%d %H:%M:%S")
         }
@@ -77,6 +142,28 @@ async def tgchat_dashboard(request):
         logging.error(f"Dashboard Error: {e}")
         return web.Response(text=f"Error: {e}", status=500)
 
+@routes.get("/tgchat/inbox")
+async def tgchat_inbox(request):
+    """
+    A page of conversations after `cursor` (the next_cursor of the previous page).
+    """
+    cursor = request.query.get('cursor')
+    conversations = await db.get_inbox(INBOX_PAGE_SIZE, parse_inbox_cursor(cursor) if cursor else None)
+    return json_response({"conversations": conversations, "next_cursor": inbox_cursor(conversations)})
+
+@routes.get("/tgchat/messages")
+async def tgchat_messages(request):
+    """
+    Messages of one conversation older than `before` (a message id), oldest first.
+    """
+    try:
+        user_id = int(request.query['user_id'])
+        before = ObjectId(request.query['before']) if request.query.get('before') else None
+    except (KeyError, ValueError, InvalidId):
+        raise web.HTTPBadRequest(text="user_id and a valid before id are required")
+    messages = await db.get_user_chats(user_id, MESSAGE_PAGE_SIZE, before)
+    return json_response({"messages": messages, "has_more": len(messages) == MESSAGE_PAGE_SIZE})
+
 # --- ROUTES ---
 @routes.get("/ws")
 async def websocket_handler(request):
@@ -89,63 +176,17 @@ async def websocket_handler(request):
         active_sockets.remove(ws)
     return ws
 
-async def notify_admin_new_message(user_id, user_name, message_text, msg_type="text"):
-    now_mm = get_timestamp()
-    
-    new_chat_entry = {
-        "message": message_text,
-        "message_type": msg_type,
-        "from_admin": False,
-        "timestamp": now_mm
-    }
-    
-    # DB Update
-    await db.chat_col.update_one(
-        {'user_id': int(user_id)},
-        {
-            '$set': {'user_name': user_name, 'last_update': now_mm},
-            '$push': {'chats': new_chat_entry}
-        },
-        upsert=True
-    )
-    
-    # Broadcast to Dashboard
-    payload = {
-        "type": "new_message",
-        "user_id": str(user_id),
-        "user_name": user_name,
-        "data": {
-            **new_chat_entry,
-            "user_name": user_name
-        }
-    }
-    for ws in list(active_sockets):
-        try: await ws.send_json(payload)
-        except: continue
-
 @routes.post("/send_message")
 async def send_message_handler(request):
     try:
         data = await request.json()
         user_id = int(data.get("user_id"))
         text = data.get("message")
-        now_mm = get_timestamp()
 
         # Telegram Send
         await multi_clients[0].send_message(chat_id=user_id, text=text)
 
-        chat_data = {
-            "message": text,
-            "message_type": "text",
-            "from_admin": True,
-            "timestamp": now_mm
-        }
-        
-        await db.chat_col.update_one(
-            {'user_id': user_id},
-            {'$push': {'chats': chat_data}},
-            upsert=True
-        )
+        await chat_ingest.add(user_id, None, text, "text", from_admin=True)
 
         return web.json_response({"status": "success"})
     except Exception as e:
@@ -182,51 +223,109 @@ async def upload_and_send_handler(request):
             await client.send_video(chat_id=user_id, video=file_path)
 
         file_url = f"/{file_path}"
-        now = get_timestamp()
-        chat_data = {"message": file_url, "message_type": "photo" if is_photo else "video", "from_admin": True, "timestamp": now}
-        
-        await db.chat_col.update_one({'user_id': user_id}, {'$push': {'chats': chat_data}}, upsert=True)
+        await chat_ingest.add(user_id, None, file_url, "photo" if is_photo else "video", from_admin=True)
         return web.json_response({"status": "success", "url": file_url})
     except Exception as e:
         return web.json_response({"error": str(e)}, status=500)
 
 
+@routes.get(r"/tgchat/media/{file_id:[A-Za-z0-9_-]+}", allow_head=True)
+async def tgchat_media(request):
+    """
+    Proxies a chat media file from the Bot API, resolving its file_id on first view.
+    """
+    file_id = request.match_info["file_id"]
+    headers = {"Range": request.headers["Range"]} if "Range" in request.headers else {}
+    session = media_resolver.get_session()
+    try:
+        for attempt in range(2):
+            file_path = await media_resolver.resolve(file_id)
+            upstream = await session.get(media_resolver.file_url(file_path), headers=headers)
+            if upstream.status != 404 or attempt:
+                break
+            # the file path expired before its ttl, resolve the file_id again
+            upstream.release()
+            media_resolver.forget(file_id)
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
+    try:
+        if upstream.status == 416:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": upstream.headers.get("Content-Range", "")})
+        if upstream.status not in (200, 206):
+            raise web.HTTPBadGateway(text=f"Telegram returned {upstream.status}")
+        response = web.StreamResponse(status=upstream.status, headers={
+            "Content-Type": mimetypes.guess_type(file_path)[0] or upstream.content_type,
+            "Accept-Ranges": "bytes",
+            # a file_id always points at the same bytes
+            "Cache-Control": "private, max-age=86400",
+        })
+        for header in ("Content-Length", "Content-Range"):
+            if header in upstream.headers:
+                response.headers[header] = upstream.headers[header]
+        await response.prepare(request)
+        if request.method != "HEAD":
+            async for chunk in upstream.content.iter_chunked(64 * 1024):
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+    finally:
+        upstream.release()
+
 
 @routes.get("/user")
 async def show_user_chats(request):
     """
-    Fetch all users and their last 50 messages
+    Fetch the 100 most recent conversations and their last 50 messages
     """
-    # Query all users who have chat
-    cursor = db.get_user_chats.find({})
-    users_chats = await cursor.to_list(length=100)  # 100 users max
-
-    # Prepare data for template
-    data = []
-    for user_doc in users_chats:
-        chats = user_doc.get('chats', [])[-50:]  # last 50 messages
-        data.append({
-            'user_name': user_doc.get('user_name'),
-            'user_id': user_doc.get('user_id'),
-            'chats': chats
-        })
+    users = await db.get_recent_chats(100, 50)
+    return await render_page(request, "chats.html", {"users": users})
 
-    return render_page("chats.html", users=data)
 
+@routes.get(r"/hls/{id:\d+}/index.m3u8", allow_head=True)
+async def hls_playlist_handler(request: web.Request):
+    try:
+        id = int(request.match_info["id"])
+        secure_hash = authorize(id, request.rel_url.query.get("hash"), request.rel_url.query.get("token"), request.remote)
+        file_id = await file_cache.get(StreamBot, id)
+        if secure_hash is not None and file_id.unique_id[:6] != secure_hash:
+            raise InvalidHash
+        if not supports_hls(file_id):
+            # progressive files are played from the stream link, their byte slices aren't HLS segments
+            raise FIleNotFound
+        return web.Response(
+            text=build_playlist(file_id, link_query(id, secure_hash, request.rel_url.query.get("token"), request.remote)),
+            content_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "public, max-age=3600"},
+        )
+    except InvalidHash as e:
+        raise web.HTTPForbidden(text=e.message)
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
 
+@routes.get(r"/hls/{id:\d+}/{segment:\d+}.seg", allow_head=True)
+async def hls_segment_handler(request: web.Request):
+    try:
+        id = int(request.match_info["id"])
+        segment = int(request.match_info["segment"])
+        secure_hash = authorize(id, request.rel_url.query.get("hash"), request.rel_url.query.get("token"), request.remote)
+        return await media_streamer(request, id, secure_hash, segment=segment)
+    except InvalidHash as e:
+        raise web.HTTPForbidden(text=e.message)
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
+    except TooManyStreams as e:
+        raise web.HTTPTooManyRequests(text=e.message)
 
-@routes.get(r"/watch/{path:\S+}", allow_head=True)
+@routes.get(rf"/watch/{{path:{LINK_PATTERN}}}", allow_head=True)
 async def stream_handler(request: web.Request):
     try:
-        path = request.match_info["path"]
-        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)$", path)
-        if match:
-            secure_hash = match.group(1)
-            id = int(match.group(2))
-        else:
-            id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
-            secure_hash = request.rel_url.query.get("hash")
-        return web.Response(text=await render_page_stream(id, secure_hash), content_type='text/html')
+        id, secure_hash = parse_link_path(
+            request.match_info["path"], request.rel_url.query.get("hash"), request.rel_url.query.get("token"), request.remote
+        )
+        return web.Response(
+            text=await render_page_stream(id, secure_hash, request.rel_url.query.get("token"), request.remote),
+            content_type='text/html',
+        )
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
@@ -237,83 +336,79 @@ async def stream_handler(request: web.Request):
         logging.critical(e.with_traceback(None))
         raise web.HTTPInternalServerError(text=str(e))
 
-@routes.get(r"/{path:\S+}", allow_head=True)
+@routes.get(rf"/{{path:{LINK_PATTERN}}}", allow_head=True)
 async def stream_handler(request: web.Request):
     try:
-        path = request.match_info["path"]
-        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)$", path)
-        if match:
-            secure_hash = match.group(1)
-            id = int(match.group(2))
-        else:
-            id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
-            secure_hash = request.rel_url.query.get("hash")
+        id, secure_hash = parse_link_path(
+            request.match_info["path"], request.rel_url.query.get("hash"), request.rel_url.query.get("token"), request.remote
+        )
         return await media_streamer(request, id, secure_hash)
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
         raise web.HTTPNotFound(text=e.message)
+    except TooManyStreams as e:
+        raise web.HTTPTooManyRequests(text=e.message)
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
     except Exception as e:
         logging.critical(e.with_traceback(None))
         raise web.HTTPInternalServerError(text=str(e))
 
-class_cache = {}
-
-async def media_streamer(request: web.Request, id: int, secure_hash: str):
+async def media_streamer(request: web.Request, id: int, secure_hash: Optional[str], segment: Optional[int] = None):
     range_header = request.headers.get("Range", 0)
     
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
+    index = scheduler.choose(id)
     
     if MULTI_CLIENT:
         logging.info(f"Client {index} is now serving {request.remote}")
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        logging.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logging.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
-    logging.debug("before calling get_file_properties")
-    file_id = await tg_connect.get_file_properties(id)
-    logging.debug("after calling get_file_properties")
+    tg_connect = get_streamer(index)
+    with tracer.span("metadata.resolve", id=id, client=index):
+        file_id = await tg_connect.get_file_properties(id)
+    scheduler.remember_dc(id, file_id.dc_id)
     
-    if file_id.unique_id[:6] != secure_hash:
+    # a None hash means the request carried a valid stream token
+    if secure_hash is not None and file_id.unique_id[:6] != secure_hash:
         logging.debug(f"Invalid hash for message with ID {id}")
         raise InvalidHash
     
     file_size = file_id.file_size
+    etag = f'"{file_id.unique_id}"'
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
+    if segment is not None:
+        # HLS segments are immutable slices of the file, served whole and cacheable
+        if not supports_hls(file_id) or segment >= segment_count(file_size):
+            raise FIleNotFound
+        etag = f'"{file_id.unique_id}-{segment}"'
+        range_header = None
 
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return web.Response(status=304, headers={"ETag": etag, "Accept-Ranges": "bytes"})
+
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range.strip() != etag:
+        # the client's copy is outdated, send the whole file
+        range_header = None
+
+    try:
+        ranges = parse_range_header(range_header, file_size) if range_header else None
+    except RangeNotSatisfiable as e:
         return web.Response(
             status=416,
-            body="416: Range not satisfiable",
+            body=e.message,
             headers={"Content-Range": f"bytes */{file_size}"},
         )
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
-
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
-
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
+    if segment is not None:
+        ranges = [segment_range(file_size, segment)]
+        status = 200
+    elif ranges is None:
+        ranges = [(0, file_size - 1)]
+        status = 200
+    else:
+        status = 206
 
     mime_type = file_id.mime_type
     file_name = file_id.file_name
@@ -327,19 +422,100 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
                 file_name = f"{secrets.token_hex(2)}.unknown"
     else:
         if file_name:
-            mime_type = mimetypes.guess_type(file_id.file_name)
+            mime_type = mimetypes.guess_type(file_id.file_name)[0] or "application/octet-stream"
         else:
             mime_type = "application/octet-stream"
             file_name = f"{secrets.token_hex(2)}.unknown"
 
-    return web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        },
-    )
+    headers = {
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+    if segment is not None:
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    if len(ranges) == 1:
+        from_bytes, until_bytes = ranges[0]
+        parts = plan_chunks(from_bytes, until_bytes)
+        headers["Content-Type"] = f"{mime_type}"
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+        if status == 206:
+            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+    else:
+        # multipart/byteranges, every range is fetched in the same pipelined pass
+        boundary = secrets.token_hex(16)
+        parts = []
+        req_length = 0
+        for from_bytes, until_bytes in ranges:
+            delimiter = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {mime_type}\r\n"
+                f"Content-Range: bytes {from_bytes}-{until_bytes}/{file_size}\r\n\r\n"
+            ).encode()
+            parts.append(delimiter)
+            parts.extend(plan_chunks(from_bytes, until_bytes))
+            parts.append(b"\r\n")
+            req_length += len(delimiter) + until_bytes - from_bytes + 1 + 2
+        closing = f"--{boundary}--\r\n".encode()
+        parts.append(closing)
+        req_length += len(closing)
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(req_length)
+
+    if STRIPED_DOWNLOAD and len(multi_clients) > 1 and len(parts) > 1:
+        body = yield_striped_file({i: get_streamer(i) for i in multi_clients}, id, parts)
+    else:
+        body = tg_connect.yield_file(file_id, index, parts, id)
+
+    response = web.StreamResponse(status=status, headers=headers)
+    return await stream_body(request, response, body, file_id.unique_id)
+
+async def stream_body(request: web.Request, response: web.StreamResponse, body, file_key: str = None) -> web.StreamResponse:
+    """
+    Writes the chunks of `body` to the client. write() waits for the transport to drain
+    once more than STREAM_WRITE_HIGH KiB are buffered, so the generator (and its
+    read-ahead window) is only pulled as fast as the client reads.
+    Every chunk is paced by the bandwidth shaper, which also caps concurrent streams.
+    """
+    try:
+        with shaper.stream(request.remote):
+            await response.prepare(request)
+            if request.transport is not None:
+                request.transport.set_write_buffer_limits(
+                    high=STREAM_WRITE_HIGH * 1024, low=STREAM_WRITE_LOW * 1024
+                )
+            metrics.stream_requests.inc(status=response.status)
+            with tracer.span("stream.write", status=response.status) as span:
+                # time spent waiting for chunks vs. waiting for the client to read them
+                written = body_wait = write_wait = 0
+                try:
+                    if request.method != "HEAD":
+                        mark = time.perf_counter()
+                        async for chunk in body:
+                            started = time.perf_counter()
+                            body_wait += started - mark
+                            await shaper.consume(request.remote, file_key, len(chunk))
+                            await response.write(chunk)
+                            mark = time.perf_counter()
+                            write_wait += mark - started
+                            written += len(chunk)
+                            metrics.stream_bytes.inc(len(chunk))
+                    await response.write_eof()
+                except ConnectionResetError:
+                    span.set_attribute("disconnected", True)
+                    logging.debug(f"Client {request.remote} disconnected while streaming")
+                except Exception as e:
+                    # the headers are already sent, so no error response can follow: closing the
+                    # connection short of Content-Length lets the player resume with a Range request
+                    span.set_attribute("error", repr(e))
+                    logging.warning(f"Closing stream to {request.remote} after {written} bytes: {e!r}")
+                    response.force_close()
+                    if request.transport is not None:
+                        request.transport.close()
+                finally:
+                    span.set_attribute("bytes", written)
+                    span.set_attribute("body_wait_ms", round(body_wait * 1000, 3))
+                    span.set_attribute("write_wait_ms", round(write_wait * 1000, 3))
+    finally:
+        await body.aclose()
+    return response
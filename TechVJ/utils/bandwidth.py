@@ -0,0 +1,112 @@
+import time
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+from config import GLOBAL_RATE_LIMIT, IP_RATE_LIMIT, FILE_RATE_LIMIT, MAX_STREAMS, MAX_STREAMS_PER_IP
+from TechVJ.server.exceptions import TooManyStreams
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """A token bucket refilled with `rate` bytes per second, holding at most `burst` bytes.
+        Waiters are served one at a time in arrival order (asyncio.Lock is FIFO), so
+        connections sharing a bucket take turns chunk by chunk instead of racing.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        self.refill()
+        return self.tokens >= self.burst and not self.lock.locked()
+
+    async def consume(self, amount: int) -> None:
+        async with self.lock:
+            self.refill()
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class BandwidthShaper:
+    max_buckets = 10000
+
+    def __init__(self, global_rate: int, ip_rate: int, file_rate: int, max_streams: int, max_streams_per_ip: int):
+        """Limits how fast and how many streams are served.
+        attributes:
+            global_rate, ip_rate, file_rate: bytes per second for all streams, per client IP and per file, 0 disables the limit.
+            max_streams, max_streams_per_ip: concurrent streams accepted, 0 disables the limit.
+
+        Every chunk written by stream_body is charged to the global, IP and file buckets
+        before it is sent, and since the read-ahead window only advances when a chunk is
+        written this also paces the GetFile requests made for the stream.
+        """
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate else None
+        self.ip_rate = ip_rate
+        self.file_rate = file_rate
+        self.max_streams = max_streams
+        self.max_streams_per_ip = max_streams_per_ip
+        self.ip_buckets: Dict[str, TokenBucket] = {}
+        self.file_buckets: Dict[str, TokenBucket] = {}
+        self.streams = Counter()
+        self.rejected = 0
+
+    def get_bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: int) -> TokenBucket:
+        if key not in buckets:
+            if len(buckets) >= self.max_buckets:
+                for idle_key in [k for k, bucket in buckets.items() if bucket.idle]:
+                    del buckets[idle_key]
+            buckets[key] = TokenBucket(rate, rate)
+        return buckets[key]
+
+    @contextmanager
+    def stream(self, ip: str):
+        """
+        Holds a stream slot for the client while the response is written, raises TooManyStreams if none is free.
+        """
+        active = sum(self.streams.values())
+        if (self.max_streams and active >= self.max_streams) or (
+            self.max_streams_per_ip and self.streams[ip] >= self.max_streams_per_ip
+        ):
+            self.rejected += 1
+            raise TooManyStreams
+        self.streams[ip] += 1
+        try:
+            yield
+        finally:
+            self.streams[ip] -= 1
+            if not self.streams[ip]:
+                del self.streams[ip]
+
+    async def consume(self, ip: str, file_key: Optional[str], amount: int) -> None:
+        if self.ip_rate:
+            await self.get_bucket(self.ip_buckets, ip, self.ip_rate).consume(amount)
+        if self.file_rate and file_key:
+            await self.get_bucket(self.file_buckets, file_key, self.file_rate).consume(amount)
+        if self.global_bucket is not None:
+            await self.global_bucket.consume(amount)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_streams": sum(self.streams.values()),
+            "clients": len(self.streams),
+            "rejected": self.rejected,
+        }
+
+
+shaper = BandwidthShaper(
+    int(GLOBAL_RATE_LIMIT * 1024 * 1024),
+    int(IP_RATE_LIMIT * 1024 * 1024),
+    int(FILE_RATE_LIMIT * 1024 * 1024),
+    MAX_STREAMS,
+    MAX_STREAMS_PER_IP,
+)
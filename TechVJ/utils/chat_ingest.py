@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+from config import CHAT_WRITE_QUEUE, CHAT_WRITE_BATCH, CHAT_WRITE_DELAY
+from plugins.dbusers import db
+
+
+class ChatIngest:
+    write_retries = 3
+
+    def __init__(self, max_queue: int, batch_size: int, delay: float):
+        """The one path chat messages take into the database and to the dashboard.
+        attributes:
+            max_queue: messages waiting to be written, add() waits for room once it is full.
+            batch_size: messages written by one insert_many.
+            delay: seconds the writer waits for more messages before writing a batch.
+            subscribers: the dashboard websockets new incoming messages are published to.
+
+        add() publishes a message right away and queues its write, a background task
+        drains the queue in batches so a burst of updates costs a few bulk writes
+        instead of two writes per message. close() flushes whatever is still queued.
+        """
+        self.queue: "asyncio.Queue[Tuple[Dict, Optional[str]]]" = asyncio.Queue(max_queue)
+        self.batch_size = batch_size
+        self.delay = delay
+        self.subscribers: Set = set()
+        self.task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.failed = 0
+
+    async def add(self, user_id, user_name, message, message_type="text", from_admin=False, media=None) -> Dict:
+        chat = db.new_chat(user_id, message, message_type, from_admin, media)
+        await self.queue.put((chat, user_name))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        if not from_admin:
+            # the admin who sent a message already shows it, only incoming ones are pushed
+            await self.publish({
+                "type": "new_message",
+                "user_id": str(chat["user_id"]),
+                "user_name": user_name,
+                "data": {
+                    "_id": str(chat["_id"]),
+                    "message": chat["message"],
+                    "message_type": chat["message_type"],
+                    "from_admin": chat["from_admin"],
+                    "timestamp": chat["timestamp"],
+                    "user_name": user_name,
+                },
+            })
+        return chat
+
+    async def publish(self, payload: Dict) -> None:
+        # sent concurrently, a slow dashboard can't hold up the others or the update handler
+        await asyncio.gather(
+            *[ws.send_json(payload) for ws in list(self.subscribers)],
+            return_exceptions=True,
+        )
+
+    async def run(self) -> None:
+        while not self.queue.empty():
+            batch = [self.queue.get_nowait()]
+            if len(batch) < self.batch_size and self.queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.write(batch)
+
+    async def write(self, batch: List[Tuple[Dict, Optional[str]]]) -> None:
+        for attempt in range(1, self.write_retries + 1):
+            try:
+                await db.add_chats(batch)
+                self.written += len(batch)
+                return
+            except Exception:
+                logging.exception(f"Failed writing {len(batch)} chat messages (attempt {attempt})")
+                if attempt < self.write_retries:
+                    await asyncio.sleep(attempt)
+        self.failed += len(batch)
+
+    async def close(self) -> None:
+        """
+        Writes every queued message, called on shutdown.
+        """
+        if self.task is not None and not self.task.done():
+            await self.task
+        if not self.queue.empty():
+            await self.run()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "failed": self.failed,
+            "subscribers": len(self.subscribers),
+        }
+
+
+chat_ingest = ChatIngest(CHAT_WRITE_QUEUE, CHAT_WRITE_BATCH, CHAT_WRITE_DELAY / 1000)
@@ -0,0 +1,136 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+from config import CHUNK_CACHE_DIR, CHUNK_CACHE_SIZE
+
+
+class ChunkCache:
+    def __init__(self, directory: str, max_size: int):
+        """A size bounded on-disk cache of media chunks shared by every client.
+        attributes:
+            directory: the folder the chunk files are stored in.
+            max_size: the maximum number of bytes kept on disk, 0 disables the cache.
+            hits, misses, evictions: counters used for tuning the cache size.
+
+        Chunks are keyed by the file unique id, the chunk size and the chunk offset,
+        so every request on the same chunk grid shares the same cached bytes.
+        The least recently used chunks are deleted once max_size is exceeded.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.current_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self.load_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @staticmethod
+    def make_key(unique_id: str, offset: int, chunk_size: int) -> str:
+        return f"{unique_id}_{chunk_size}_{offset}"
+
+    def load_index(self) -> None:
+        """
+        Rebuilds the LRU index from the files left on disk by a previous run,
+        oldest modification time first.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.current_size += size
+        self.evict()
+        logging.debug(f"Loaded {len(self.entries)} cached chunks from {self.directory}")
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = os.path.join(self.directory, key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def contains(self, unique_id: str, offset: int, chunk_size: int) -> bool:
+        return self.enabled and self.make_key(unique_id, offset, chunk_size) in self.entries
+
+    async def get(self, unique_id: str, offset: int, chunk_size: int) -> Optional[bytes]:
+        """
+        Returns the cached chunk or None if it is not on disk.
+        """
+        if not self.enabled:
+            return None
+        key = self.make_key(unique_id, offset, chunk_size)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        data = await asyncio.to_thread(self._read, key)
+        if data is None:
+            self.current_size -= self.entries.pop(key, 0)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, unique_id: str, offset: int, chunk_size: int, data: bytes) -> None:
+        """
+        Stores a chunk on disk and evicts the least recently used chunks if needed.
+        """
+        if not self.enabled or not data or len(data) > self.max_size:
+            return
+        key = self.make_key(unique_id, offset, chunk_size)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError:
+            logging.warning(f"Failed writing chunk {key} to the cache", exc_info=True)
+            return
+        self.entries[key] = len(data)
+        self.current_size += len(data)
+        self.evict()
+
+    def evict(self) -> None:
+        while self.current_size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.current_size -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "chunks": len(self.entries),
+            "size": self.current_size,
+            "max_size": self.max_size,
+        }
+
+
+chunk_cache = ChunkCache(CHUNK_CACHE_DIR, CHUNK_CACHE_SIZE * 1024 * 1024)
@@ -0,0 +1,238 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from pyrogram import Client
+from pyrogram.file_id import FileId
+from config import (
+    LOG_CHANNEL,
+    METADATA_CACHE_BACKEND,
+    METADATA_CACHE_SIZE,
+    METADATA_CACHE_TTL,
+    METADATA_CACHE_SQLITE,
+    NEGATIVE_CACHE_TTL,
+)
+from TechVJ.server.exceptions import FIleNotFound
+from .file_properties import get_file_ids
+
+
+def dump_file_id(file_id: FileId) -> dict:
+    return {
+        "file_id": file_id.encode(),
+        "file_size": getattr(file_id, "file_size", 0),
+        "mime_type": getattr(file_id, "mime_type", ""),
+        "file_name": getattr(file_id, "file_name", ""),
+        "unique_id": getattr(file_id, "unique_id", ""),
+        "duration": getattr(file_id, "duration", 0),
+    }
+
+
+def load_file_id(data: dict) -> FileId:
+    file_id = FileId.decode(data["file_id"])
+    for attr in ("file_size", "mime_type", "file_name", "unique_id", "duration"):
+        setattr(file_id, attr, data.get(attr))
+    return file_id
+
+
+class MongoMetaStore:
+    """Keeps the cached file properties in the bot's MongoDB database."""
+
+    def __init__(self, collection):
+        self.col = collection
+
+    async def load(self, key: str) -> Optional[dict]:
+        return await self.col.find_one({"_id": key})
+
+    async def save(self, key: str, data: dict) -> None:
+        await self.col.replace_one({"_id": key}, {"_id": key, **data}, upsert=True)
+
+
+class SQLiteMetaStore:
+    """Keeps the cached file properties in a local SQLite file."""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = asyncio.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_meta ("
+            "key TEXT PRIMARY KEY, file_id TEXT, file_size INTEGER, mime_type TEXT,"
+            "file_name TEXT, unique_id TEXT, duration INTEGER, expires_at REAL)"
+        )
+        self.conn.commit()
+
+    def _load(self, key: str) -> Optional[dict]:
+        row = self.conn.execute(
+            "SELECT file_id, file_size, mime_type, file_name, unique_id, duration, expires_at"
+            " FROM file_meta WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("file_id", "file_size", "mime_type", "file_name", "unique_id", "duration", "expires_at"), row))
+
+    def _save(self, key: str, data: dict) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO file_meta VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, data["file_id"], data["file_size"], data["mime_type"],
+             data["file_name"], data["unique_id"], data["duration"], data["expires_at"]),
+        )
+        self.conn.commit()
+
+    async def load(self, key: str) -> Optional[dict]:
+        async with self.lock:
+            return await asyncio.to_thread(self._load, key)
+
+    async def save(self, key: str, data: dict) -> None:
+        async with self.lock:
+            await asyncio.to_thread(self._save, key, data)
+
+
+class FileMetaCache:
+    def __init__(self, max_entries: int, ttl: int, store=None, missing_ttl: int = 0):
+        """A bounded LRU cache of file properties shared by every ByteStreamer and the watch page.
+        attributes:
+            max_entries: the maximum number of FileId objects kept in memory.
+            ttl: seconds an entry stays valid, each entry gets up to 10% jitter so they don't expire together.
+            store: optional MongoMetaStore / SQLiteMetaStore so the cache survives restarts.
+            missing_ttl: seconds a message id without media is remembered, so repeated requests
+                for it (scanners, dead links) are rejected without calling Telegram. 0 disables it.
+
+        FileIds are bound to the bot that resolved them, so entries are keyed by the client name and message id.
+        Entries used during the last 20% of their lifetime are refreshed in the background,
+        and concurrent misses on the same key share one get_messages call.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.refresh_ratio = 0.8
+        self.entries: "OrderedDict[str, Tuple[FileId, float]]" = OrderedDict()
+        self.missing_ttl = missing_ttl
+        self.missing: "OrderedDict[int, float]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.rejected = 0
+
+    @staticmethod
+    def make_key(client: Client, id: int) -> str:
+        return f"{client.name}:{id}"
+
+    def new_expiry(self) -> float:
+        return time.time() + self.ttl * random.uniform(0.9, 1.0)
+
+    def peek(self, client: Client, id: int) -> Optional[FileId]:
+        """
+        Returns the cached properties without touching Telegram, or None.
+        """
+        entry = self.entries.get(self.make_key(client, id))
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    async def get(self, client: Client, id: int) -> FileId:
+        """
+        Returns the properties of the media in message `id` of the LOG_CHANNEL,
+        resolving them with `client` when they are missing or expired.
+        """
+        key = self.make_key(client, id)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry and entry[1] > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if entry[1] - now < self.ttl * (1 - self.refresh_ratio) and key not in self.inflight:
+                self.refreshes += 1
+                self.resolve(client, id, key)
+            return entry[0]
+        expires_at = self.missing.get(id)
+        if expires_at is not None:
+            if expires_at > now:
+                self.rejected += 1
+                raise FIleNotFound
+            del self.missing[id]
+        self.misses += 1
+        return await asyncio.shield(self.resolve(client, id, key))
+
+    def resolve(self, client: Client, id: int, key: str) -> asyncio.Future:
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load(client, id, key))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.forget(key, t))
+        return task
+
+    def forget(self, key: str, task: asyncio.Future) -> None:
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logging.debug(f"Failed resolving file properties for {key}: {task.exception()!r}")
+
+    async def load(self, client: Client, id: int, key: str) -> FileId:
+        if self.store is not None and key not in self.entries:
+            try:
+                data = await self.store.load(key)
+            except Exception:
+                logging.warning("Failed reading the metadata store", exc_info=True)
+                data = None
+            if data and data.get("expires_at", 0) > time.time():
+                file_id = load_file_id(data)
+                self.set(key, file_id, data["expires_at"])
+                return file_id
+
+        try:
+            file_id = await get_file_ids(client, LOG_CHANNEL, id)
+        except FIleNotFound:
+            self.set_missing(id)
+            raise
+        expires_at = self.new_expiry()
+        self.set(key, file_id, expires_at)
+        logging.debug(f"Cached file properties for message with ID {id}")
+        if self.store is not None:
+            try:
+                await self.store.save(key, {**dump_file_id(file_id), "expires_at": expires_at})
+            except Exception:
+                logging.warning("Failed writing the metadata store", exc_info=True)
+        return file_id
+
+    def set(self, key: str, file_id: FileId, expires_at: float) -> None:
+        self.entries[key] = (file_id, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set_missing(self, id: int) -> None:
+        if not self.missing_ttl:
+            return
+        # a message id is missing for every client, so these aren't keyed by client name
+        self.missing[id] = time.time() + self.missing_ttl
+        self.missing.move_to_end(id)
+        while len(self.missing) > self.max_entries:
+            self.missing.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "entries": len(self.entries),
+            "missing": len(self.missing),
+            "rejected": self.rejected,
+        }
+
+
+def get_meta_store():
+    if METADATA_CACHE_BACKEND == "mongodb":
+        from plugins.dbusers import db
+        return MongoMetaStore(db.db.file_meta)
+    if METADATA_CACHE_BACKEND == "sqlite":
+        return SQLiteMetaStore(METADATA_CACHE_SQLITE)
+    return None
+
+
+file_cache = FileMetaCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL, get_meta_store(), NEGATIVE_CACHE_TTL)
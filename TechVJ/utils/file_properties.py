@@ -4,6 +4,7 @@ from pyrogram.types import Message
 from pyrogram.file_id import FileId
 from pyrogram.raw.types.messages import Messages
 from TechVJ.server.exceptions import FIleNotFound
+from .message_batcher import get_message
 
 
 async def parse_file_id(message: "Message") -> Optional[FileId]:
@@ -17,15 +18,18 @@ async def parse_file_unique_id(message: "Messages") -> Optional[str]:
         return media.file_unique_id
 
 async def get_file_ids(client: Client, chat_id: int, id: int) -> Optional[FileId]:
-    message = await client.get_messages(chat_id, id)
+    message = await get_message(client, chat_id, id)
     if message.empty:
         raise FIleNotFound
     media = get_media_from_message(message)
+    if not media:
+        raise FIleNotFound
     file_unique_id = await parse_file_unique_id(message)
     file_id = await parse_file_id(message)
     setattr(file_id, "file_size", getattr(media, "file_size", 0))
     setattr(file_id, "mime_type", getattr(media, "mime_type", ""))
     setattr(file_id, "file_name", getattr(media, "file_name", ""))
+    setattr(file_id, "duration", getattr(media, "duration", 0) or 0)
     setattr(file_id, "unique_id", file_unique_id)
     return file_id
 
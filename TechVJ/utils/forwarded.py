@@ -0,0 +1,24 @@
+from typing import Optional
+from aiohttp import web
+from config import TRUSTED_PROXIES
+
+
+def client_ip(request: web.Request, hops: int = TRUSTED_PROXIES) -> Optional[str]:
+    """
+    Returns the viewer's address. Behind `hops` trusted proxies it is the entry that many
+    places from the end of X-Forwarded-For, entries further left are set by the client and can be forged.
+    """
+    if hops <= 0:
+        return request.remote
+    forwarded = [ip.strip() for ip in request.headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+    if not forwarded:
+        return request.remote
+    return forwarded[-min(hops, len(forwarded))]
+
+
+@web.middleware
+async def forwarded_middleware(request: web.Request, handler):
+    """Replaces request.remote with the client IP, so per-IP limits and IP-bound links see the viewer and not the proxy."""
+    if TRUSTED_PROXIES > 0:
+        request = request.clone(remote=client_ip(request))
+    return await handler(request)
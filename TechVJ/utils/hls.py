@@ -0,0 +1,67 @@
+import math
+from typing import Tuple
+from pyrogram.file_id import FileId
+from config import HLS_SEGMENT_SIZE
+
+SEGMENT_SIZE = HLS_SEGMENT_SIZE * 1024 * 1024
+DEFAULT_SEGMENT_DURATION = 10
+# byte slices of a file are only valid HLS segments for MPEG-TS, MP4/MKV need remuxing
+HLS_MIME_TYPES = ("video/mp2t",)
+TS_PACKET_SIZE = 188
+
+
+def supports_hls(file_id: FileId) -> bool:
+    return (getattr(file_id, "mime_type", "") or "").lower() in HLS_MIME_TYPES
+
+
+def segment_count(file_size: int) -> int:
+    return max(1, math.ceil(file_size / SEGMENT_SIZE))
+
+
+def segment_range(file_size: int, segment: int) -> Tuple[int, int]:
+    """
+    Returns the inclusive byte range of a segment. Segments are about HLS_SEGMENT_SIZE MiB,
+    cut on the MPEG-TS packet boundary before each multiple of it, the last one holds the rest of the file.
+    """
+    def boundary(n: int) -> int:
+        return n * SEGMENT_SIZE // TS_PACKET_SIZE * TS_PACKET_SIZE
+
+    from_bytes = boundary(segment)
+    until_bytes = min(boundary(segment + 1), file_size) - 1
+    if segment == segment_count(file_size) - 1:
+        until_bytes = file_size - 1
+    return from_bytes, until_bytes
+
+
+def build_playlist(file_id: FileId, query: str) -> str:
+    """
+    Builds a VOD playlist mapping fixed size byte segments of the original file, without transcoding.
+    Segment durations are estimated from the media duration assuming a constant bitrate.
+    Segments are served from /hls/{id}/{n}.seg?{query} next to the playlist with long lived cache
+    headers, so players and edge caches can reuse them.
+    """
+    file_size = file_id.file_size
+    count = segment_count(file_size)
+    duration = getattr(file_id, "duration", 0) or 0
+    if duration and file_size:
+        seconds_per_byte = duration / file_size
+    else:
+        seconds_per_byte = DEFAULT_SEGMENT_DURATION / SEGMENT_SIZE
+
+    durations = []
+    for segment in range(count):
+        from_bytes, until_bytes = segment_range(file_size, segment)
+        durations.append((until_bytes - from_bytes + 1) * seconds_per_byte)
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(durations)))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for segment, seconds in enumerate(durations):
+        lines.append(f"#EXTINF:{seconds:.3f},")
+        lines.append(f"{segment}.seg?{query}")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
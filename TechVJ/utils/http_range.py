@@ -0,0 +1,82 @@
+from typing import List, Optional, Tuple
+from TechVJ.server.exceptions import RangeNotSatisfiable
+
+MAX_RANGES = 16
+
+
+def parse_range_header(header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a `Range: bytes=...` header into a sorted list of inclusive (start, end) ranges,
+    merging overlapping and adjacent ones. Supports closed (0-99), open (100-) and suffix (-500) ranges.
+    Returns None when the header should be ignored and the whole file served,
+    raises RangeNotSatisfiable when none of the ranges overlap the file.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or last.isdigit()):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # suffix range, the last N bytes of the file
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(file_size - length, 0), file_size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= file_size:
+            continue
+        end = int(last) if last else file_size - 1
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        # too many small ranges cost more than serving the whole file
+        return None
+    return merged
+
+
+def plan_parts(from_bytes: int, until_bytes: int, chunk_size: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Splits an inclusive byte range on the chunk grid.
+    Returns (chunk offset, chunk size, first byte, end byte) tuples, the bytes are relative to the chunk.
+    """
+    parts = []
+    offset = from_bytes - (from_bytes % chunk_size)
+    while offset <= until_bytes:
+        parts.append((
+            offset,
+            chunk_size,
+            max(from_bytes - offset, 0),
+            min(until_bytes - offset + 1, chunk_size),
+        ))
+        offset += chunk_size
+    return parts
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    Returns True if an If-None-Match / If-Range header value matches the entity tag.
+    """
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
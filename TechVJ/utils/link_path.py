@@ -0,0 +1,63 @@
+import re
+from typing import Optional, Tuple
+from config import LEGACY_HASH_LINKS
+from TechVJ.server.exceptions import FIleNotFound, InvalidHash
+from .stream_token import verify_token
+
+HASH_PATTERN = r"[a-zA-Z0-9_-]{6}"
+ID_PATTERN = r"\d{1,10}"
+# {hash}{id} or {id}/{file name}?token=... (or ?hash=...), used as the route pattern so other paths never reach a handler
+LINK_PATTERN = rf"{HASH_PATTERN}{ID_PATTERN}|{ID_PATTERN}(?:/\S*)?"
+
+LINK_PATH = re.compile(rf"(?:(?P<hash>{HASH_PATTERN})(?P<id>{ID_PATTERN})|(?P<plain_id>{ID_PATTERN})(?:/\S*)?)")
+HASH = re.compile(HASH_PATTERN)
+MAX_MESSAGE_ID = 2 ** 31 - 1
+
+
+def check_hash(secure_hash: Optional[str]) -> str:
+    """
+    Rejects a missing or malformed ?hash= before the file is looked up.
+    """
+    if not secure_hash or not HASH.fullmatch(secure_hash):
+        raise InvalidHash
+    return secure_hash
+
+
+def check_id(id: int) -> int:
+    if not 0 < id <= MAX_MESSAGE_ID:
+        raise FIleNotFound
+    return id
+
+
+def authorize(id: int, query_hash: Optional[str], token: Optional[str], ip: Optional[str]) -> Optional[str]:
+    """
+    Verifies a signed stream token, or falls back to the legacy hash while LEGACY_HASH_LINKS is on.
+    Returns the hash still to be compared with the file's unique id, or None when the token already granted access.
+    """
+    check_id(id)
+    if token:
+        verify_token(token, id, ip)
+        return None
+    if not LEGACY_HASH_LINKS:
+        raise InvalidHash
+    return check_hash(query_hash)
+
+
+def parse_link_path(
+    path: str, query_hash: Optional[str], token: Optional[str] = None, ip: Optional[str] = None
+) -> Tuple[int, Optional[str]]:
+    """
+    Returns the (message id, secure hash) of a stream link path, in one pass of a precompiled pattern.
+    The hash is None when the link carried a valid stream token.
+    Raises FIleNotFound for paths that aren't stream links and InvalidHash for malformed hashes
+    or tokens, so neither costs a Telegram call.
+    """
+    match = LINK_PATH.fullmatch(path)
+    if match is None:
+        raise FIleNotFound
+    if match["id"]:
+        if not LEGACY_HASH_LINKS:
+            raise InvalidHash
+        return check_id(int(match["id"])), match["hash"]
+    id = int(match["plain_id"])
+    return id, authorize(id, query_hash, token, ip)
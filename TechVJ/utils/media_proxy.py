@@ -0,0 +1,101 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from config import BOT_TOKEN, MEDIA_URL_TTL, MEDIA_PROXY_CONNECTIONS
+from TechVJ.server.exceptions import FIleNotFound
+from .tracing import tracer
+
+API_URL = "https://api.telegram.org"
+
+
+def media_url(file_id: str) -> str:
+    """
+    Returns the dashboard URL of a chat media file, what is stored in the message instead of a Bot API link.
+    """
+    return f"/tgchat/media/{file_id}"
+
+
+class MediaResolver:
+    def __init__(self, ttl: int, connections: int, max_entries: int = 4096):
+        """Resolves chat media file_ids to Bot API file paths for the dashboard media proxy.
+        attributes:
+            ttl: seconds a resolved file path is reused, Telegram keeps them valid for at least an hour.
+            connections: size of the connection pool shared by getFile calls and the proxied downloads.
+            max_entries: resolved file paths kept in memory.
+
+        Media is only resolved when a dashboard shows it, so saving an incoming message makes no
+        HTTP call. Concurrent requests for the same file share one getFile call, and the bot
+        token never leaves the server since the bytes are proxied.
+        """
+        self.ttl = ttl
+        self.connections = connections
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.session: Optional[ClientSession] = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_session(self) -> ClientSession:
+        # created on first use, a ClientSession must be made inside the running loop
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.connections),
+                timeout=ClientTimeout(total=None, connect=10, sock_read=30),
+            )
+        return self.session
+
+    def file_url(self, file_path: str) -> str:
+        return f"{API_URL}/file/bot{BOT_TOKEN}/{file_path}"
+
+    async def resolve(self, file_id: str) -> str:
+        """
+        Returns the Bot API file path of `file_id`, raises FIleNotFound when Telegram won't serve it
+        (an unknown file_id or a file over the Bot API's 20 MB download limit).
+        """
+        entry = self.entries.get(file_id)
+        if entry and entry[1] > time.time():
+            self.entries.move_to_end(file_id)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        task = self.inflight.get(file_id)
+        if task is None:
+            task = asyncio.ensure_future(self.get_file(file_id))
+            self.inflight[file_id] = task
+            task.add_done_callback(lambda t: self.inflight.pop(file_id, None))
+        return await asyncio.shield(task)
+
+    async def get_file(self, file_id: str) -> str:
+        with tracer.span("bot_api.getFile"):
+            async with self.get_session().get(f"{API_URL}/bot{BOT_TOKEN}/getFile", params={"file_id": file_id}) as r:
+                data = await r.json()
+        if not data.get("ok"):
+            logging.debug(f"getFile failed for {file_id}: {data.get('description')}")
+            raise FIleNotFound
+        file_path = data["result"]["file_path"]
+        self.entries[file_id] = (file_path, time.time() + self.ttl)
+        self.entries.move_to_end(file_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return file_path
+
+    def forget(self, file_id: str) -> None:
+        self.entries.pop(file_id, None)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
+
+
+media_resolver = MediaResolver(MEDIA_URL_TTL, MEDIA_PROXY_CONNECTIONS)
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from pyrogram import Client
+from pyrogram.types import Message
+from config import MESSAGE_BATCH_DELAY
+from TechVJ.server.exceptions import FIleNotFound
+
+
+class MessageBatcher:
+    max_size = 200  # get_messages accepts up to 200 ids per call
+
+    def __init__(self, client: Client, chat_id: int, delay: float):
+        """Collects message lookups for a few milliseconds and resolves them with one get_messages call.
+        attributes:
+            client: the client used for the lookups.
+            chat_id: the chat the messages belong to.
+            delay: seconds to wait for more ids before sending the batch.
+        """
+        self.client = client
+        self.chat_id = chat_id
+        self.delay = delay
+        self.pending: Dict[int, List[asyncio.Future]] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def get(self, id: int) -> Message:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(id, []).append(future)
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.ensure_future(self.resolve(batch))
+
+    async def resolve(self, batch: Dict[int, List[asyncio.Future]]) -> None:
+        ids = list(batch)
+        logging.debug(f"Resolving {len(ids)} messages from {self.chat_id} in one call")
+        try:
+            messages = await self.client.get_messages(self.chat_id, ids)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        found = {message.id: message for message in messages}
+        for id, futures in batch.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if id in found:
+                    future.set_result(found[id])
+                else:
+                    future.set_exception(FIleNotFound())
+
+
+batchers: Dict[Tuple[str, int], MessageBatcher] = {}
+
+
+async def get_message(client: Client, chat_id: int, id: int) -> Message:
+    """
+    Returns message `id` of `chat_id`, batched with the other lookups made
+    by the same client in the next MESSAGE_BATCH_DELAY milliseconds.
+    """
+    key = (client.name, chat_id)
+    if key not in batchers:
+        batchers[key] = MessageBatcher(client, chat_id, MESSAGE_BATCH_DELAY / 1000)
+    return await batchers[key].get(int(id))
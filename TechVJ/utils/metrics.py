@@ -0,0 +1,142 @@
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+from pymongo import monitoring
+
+
+def format_labels(labelnames: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        """A metric in the Prometheus text format, samples are keyed by their label values.
+        The lock guards the samples, MongoDB commands are observed from motor's executor threads."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.samples: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            samples = sorted(self.samples.items())
+        for values, value in samples:
+            lines.append(f"{self.name}{format_labels(self.labelnames, values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.samples[key] = value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.samples.clear()
+
+
+class CounterSnapshot(Gauge):
+    """A counter kept elsewhere (scheduler, caches), copied in when /metrics is scraped."""
+
+    type = "counter"
+
+
+class Histogram(Metric):
+    type = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[Tuple, List[int]] = {}
+        self.sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.counts:
+                self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            self.counts[key][bucket] += 1
+            self.sums[key] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            series = sorted((values, list(counts), self.sums[values]) for values, counts in self.counts.items())
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records the latency of every MongoDB command, passed to the motor client as an event listener."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name, status="ok")
+
+    def failed(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name, status="error")
+
+
+getfile_latency = Histogram("getfile_latency_seconds", "Latency of upload.GetFile calls.", ("dc",))
+stream_bytes = Counter("stream_bytes_total", "Bytes written to HTTP streaming clients.")
+stream_requests = Counter("stream_requests_total", "Streaming responses started.", ("status",))
+mongo_latency = Histogram("mongodb_command_seconds", "Latency of MongoDB commands.", ("command", "status"))
+
+client_work_load = Gauge("client_work_load", "Streams currently served by each bot client.", ("client",))
+client_throughput = Gauge("client_throughput_bytes", "Smoothed GetFile throughput of each bot client in bytes per second.", ("client",))
+client_bytes = CounterSnapshot("client_bytes_total", "Bytes downloaded from Telegram by each bot client.", ("client",))
+client_requests = CounterSnapshot("client_getfile_requests_total", "GetFile requests sent by each bot client.", ("client",))
+client_errors = CounterSnapshot("client_getfile_errors_total", "Failed GetFile requests of each bot client.", ("client",))
+client_flood_waits = CounterSnapshot("client_flood_waits_total", "FloodWait errors received by each bot client.", ("client",))
+active_streams = Gauge("active_streams", "Streaming responses currently being written.")
+rejected_streams = CounterSnapshot("rejected_streams_total", "Streams refused because of MAX_STREAMS limits.")
+cache_hits = CounterSnapshot("cache_hits_total", "Cache hits.", ("cache",))
+cache_misses = CounterSnapshot("cache_misses_total", "Cache misses.", ("cache",))
+cache_hit_ratio = Gauge("cache_hit_ratio", "Share of lookups served from the cache.", ("cache",))
+websocket_connections = Gauge("websocket_connections", "Open dashboard websockets.")
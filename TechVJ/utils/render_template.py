@@ -1,12 +1,12 @@
-import jinja2
-from config import LOG_CHANNEL, URL
+from config import HLS_MODE, URL
 from TechVJ.bot import StreamBot
 from TechVJ.utils.human_readable import humanbytes
-from TechVJ.utils.file_properties import get_file_ids
+from TechVJ.utils.file_cache import file_cache
 from TechVJ.server.exceptions import InvalidHash
+from TechVJ.utils.stream_token import link_query
+from TechVJ.utils.hls import supports_hls
 import urllib.parse
 import logging
-import aiohttp
 
 
 # TechVJ/utils/render_template.py
@@ -16,7 +16,8 @@ from jinja2 import Environment, FileSystemLoader
 
 env = Environment(
     loader=FileSystemLoader("TechVJ/template"),
-    autoescape=True
+    autoescape=True,
+    auto_reload=False  # compiled templates stay cached, restart to pick up template edits
 )
 
 async def render_page(request, template_name, context=None):
@@ -30,38 +31,35 @@ async def render_page(request, template_name, context=None):
 
 
 
-async def render_page_stream(id, secure_hash, src=None):
-    file = await StreamBot.get_messages(int(LOG_CHANNEL), int(id))
-    file_data = await get_file_ids(StreamBot, int(LOG_CHANNEL), int(id))
-    if file_data.unique_id[:6] != secure_hash:
+async def render_page_stream(id, secure_hash, token=None, remote=None):
+    file_data = await file_cache.get(StreamBot, int(id))
+    # secure_hash is None when the page was opened with a valid stream token
+    if secure_hash is not None and file_data.unique_id[:6] != secure_hash:
         logging.debug(f"link hash: {secure_hash} - {file_data.unique_id[:6]}")
         logging.debug(f"Invalid hash for message with - ID {id}")
         raise InvalidHash
 
+    query = link_query(int(id), secure_hash, token, remote)
     src = urllib.parse.urljoin(
         URL,
-        f"{id}/{urllib.parse.quote_plus(file_data.file_name)}?hash={secure_hash}",
+        f"{id}/{urllib.parse.quote_plus(file_data.file_name)}?{query}",
     )
 
     tag = file_data.mime_type.split("/")[0].strip()
-    file_size = humanbytes(file_data.file_size)
+    hls_url = None
+    if HLS_MODE and supports_hls(file_data):
+        hls_url = urllib.parse.urljoin(URL, f"hls/{id}/index.m3u8?{query}")
     if tag in ["video", "audio"]:
-        template_file = "TechVJ/template/req.html"
+        template = env.get_template("req.html")
     else:
-        template_file = "TechVJ/template/dl.html"
-        async with aiohttp.ClientSession() as s:
-            async with s.get(src) as u:
-                file_size = humanbytes(int(u.headers.get("Content-Length")))
-
-    with open(template_file) as f:
-        template = jinja2.Template(f.read())
+        template = env.get_template("dl.html")
 
     file_name = file_data.file_name.replace("_", " ")
 
     return template.render(
         file_name=file_name,
         file_url=src,
-        file_size=file_size,
+        hls_url=hls_url,
+        file_size=humanbytes(file_data.file_size),
         file_unique_id=file_data.unique_id,
     )
-    return html
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import itertools
+from typing import Dict, List
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid, RPCError
+from config import MEDIA_SESSIONS_PER_DC, MEDIA_SESSION_CHECK_INTERVAL
+
+TELEGRAM_DCS = (1, 2, 3, 4, 5)
+
+
+class MediaSessionPool:
+    def __init__(self, client: Client, size: int):
+        """Keeps several media sessions per DC for one client.
+        attributes:
+            client: the client the sessions belong to.
+            size: the number of sessions kept for every DC.
+            sessions: a dict of DC id to the list of started sessions, handed out round robin.
+
+        Creation is guarded by a lock per DC so concurrent first requests can't
+        race and create duplicate sessions. The first session of every DC is also
+        registered in client.media_sessions, like pyrogram does for its own sessions.
+        """
+        self.client = client
+        self.size = max(1, size)
+        self.sessions: Dict[int, List[Session]] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.counter = itertools.count()
+        self.health_task = None
+
+    async def get(self, dc_id: int) -> Session:
+        """
+        Returns a media session for the DC, creating the first one if needed.
+        """
+        self.start_health_check()
+        if not self.sessions.get(dc_id):
+            async with self.locks.setdefault(dc_id, asyncio.Lock()):
+                if not self.sessions.get(dc_id):
+                    await self.add_session(dc_id)
+                    asyncio.create_task(self.fill(dc_id))
+        else:
+            logging.debug(f"Using cached media session for DC {dc_id}")
+        sessions = self.sessions[dc_id]
+        return sessions[next(self.counter) % len(sessions)]
+
+    async def fill(self, dc_id: int) -> None:
+        async with self.locks.setdefault(dc_id, asyncio.Lock()):
+            while len(self.sessions.get(dc_id, [])) < self.size:
+                try:
+                    await self.add_session(dc_id)
+                except Exception:
+                    logging.warning(f"Failed creating media session for DC {dc_id}", exc_info=True)
+                    return
+
+    async def add_session(self, dc_id: int) -> Session:
+        media_session = await self.create_session(dc_id)
+        self.sessions.setdefault(dc_id, []).append(media_session)
+        self.client.media_sessions.setdefault(dc_id, media_session)
+        return media_session
+
+    async def create_session(self, dc_id: int) -> Session:
+        """
+        Generates a media session for the DC.
+        This is required for getting the bytes from Telegram servers.
+        """
+        client = self.client
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.send(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
+                        )
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        f"Invalid authorization bytes for DC {dc_id}"
+                    )
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+        else:
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        logging.debug(f"Created media session for DC {dc_id}")
+        return media_session
+
+    async def warm_up(self) -> None:
+        """
+        Creates the sessions for every DC up front so the first viewer doesn't wait for the auth dance.
+        """
+        results = await asyncio.gather(*[self.fill(dc_id) for dc_id in TELEGRAM_DCS], return_exceptions=True)
+        for dc_id, result in zip(TELEGRAM_DCS, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Failed warming up media sessions for DC {dc_id}: {result!r}")
+        self.start_health_check()
+
+    def start_health_check(self) -> None:
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self.health_check())
+
+    async def is_alive(self, media_session: Session) -> bool:
+        try:
+            await media_session.send(raw.functions.Ping(ping_id=0), timeout=10)
+            return True
+        except (TimeoutError, OSError, RPCError):
+            return False
+
+    async def retire(self, media_session: Session) -> None:
+        """
+        Stops a session taken out of rotation once the requests still waiting on it have finished or timed out.
+        """
+        while media_session.results:
+            await asyncio.sleep(1)
+        try:
+            await media_session.stop()
+        except Exception:
+            pass
+
+    async def health_check(self) -> None:
+        """
+        Pings every session periodically and replaces the ones that stopped answering.
+        """
+        while True:
+            await asyncio.sleep(MEDIA_SESSION_CHECK_INTERVAL)
+            for dc_id, sessions in list(self.sessions.items()):
+                for media_session in list(sessions):
+                    if await self.is_alive(media_session):
+                        continue
+                    logging.warning(f"Replacing dead media session for DC {dc_id}")
+                    sessions.remove(media_session)
+                    if self.client.media_sessions.get(dc_id) is media_session:
+                        self.client.media_sessions.pop(dc_id)
+                        if sessions:
+                            self.client.media_sessions[dc_id] = sessions[0]
+                    asyncio.create_task(self.retire(media_session))
+                await self.fill(dc_id)
+
+session_pools: Dict[str, MediaSessionPool] = {}
+
+
+def get_session_pool(client: Client) -> MediaSessionPool:
+    if client.name not in session_pools:
+        session_pools[client.name] = MediaSessionPool(client, MEDIA_SESSIONS_PER_DC)
+    return session_pools[client.name]
+
+
+async def warm_up_media_sessions(clients: Dict[int, Client]) -> None:
+    await asyncio.gather(*[get_session_pool(client).warm_up() for client in clients.values()])
+    logging.info("Media sessions are ready")
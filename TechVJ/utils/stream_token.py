@@ -0,0 +1,61 @@
+import hmac
+import time
+import base64
+import hashlib
+from typing import Optional
+from config import BOT_TOKEN, STREAM_SECRET, STREAM_TOKEN_TTL, STREAM_TOKEN_BIND_IP
+from TechVJ.server.exceptions import InvalidHash, LinkExpired
+
+# without STREAM_SECRET the key is derived from the bot token, so links survive restarts
+SECRET = (STREAM_SECRET or hashlib.sha256(f"stream-token:{BOT_TOKEN}".encode()).hexdigest()).encode()
+
+
+def sign(payload: str, ip: Optional[str]) -> str:
+    digest = hmac.new(SECRET, f"{payload}|{ip or ''}".encode(), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def make_token(id: int, ttl: int = STREAM_TOKEN_TTL, ip: Optional[str] = None, expires_at: Optional[int] = None) -> str:
+    """
+    Returns a signed token granting access to message `id` until `ttl` seconds from now, or until `expires_at`.
+    With `ip` the token only works for requests from that address, the IP is covered by the
+    signature but not written into the token.
+    """
+    if expires_at is None:
+        expires_at = int(time.time()) + ttl
+    payload = f"{id:x}.{expires_at:x}.{1 if ip else 0}"
+    return f"{payload}.{sign(payload, ip)}"
+
+
+def verify_token(token: str, id: int, ip: Optional[str] = None) -> None:
+    """
+    Checks a stream token in-process, raises InvalidHash when it is forged or made for
+    another message and LinkExpired once it is past its expiry.
+    """
+    try:
+        token_id, expires_at, bound, signature = token.split(".")
+        token_id, expires_at = int(token_id, 16), int(expires_at, 16)
+    except ValueError:
+        raise InvalidHash
+    payload = f"{token_id:x}.{expires_at:x}.{bound}"
+    if token_id != id or bound not in ("0", "1"):
+        raise InvalidHash
+    if not hmac.compare_digest(signature, sign(payload, ip if bound == "1" else None)):
+        raise InvalidHash
+    if expires_at < time.time():
+        raise LinkExpired
+
+
+def link_query(id: int, secure_hash: Optional[str], token: Optional[str] = None, ip: Optional[str] = None) -> str:
+    """
+    Returns the query string for links embedded in a page: the legacy hash the page was
+    opened with, or the (already verified) token it was opened with. The links never outlive
+    that token, with STREAM_TOKEN_BIND_IP an unbound token is re-signed for the viewer's IP
+    with its original expiry.
+    """
+    if secure_hash:
+        return f"hash={secure_hash}"
+    _, expires_at, bound, _ = token.split(".")
+    if STREAM_TOKEN_BIND_IP and ip and bound == "0":
+        token = make_token(id, ip=ip, expires_at=int(expires_at, 16))
+    return f"token={token}"
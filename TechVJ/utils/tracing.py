@@ -0,0 +1,228 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import secrets
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+import aiohttp
+from aiohttp import web
+from config import TRACE_SAMPLE_RATE, TRACE_EXPORTER, TRACE_OTLP_ENDPOINT, TRACE_MAX_SPANS
+
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class NoopSpan:
+    """Returned when the request isn't sampled, so instrumented code costs next to nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+    def __init__(self, tracer: "Tracer", trace_id: str):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.spans = 0
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Dict[str, object]):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = 0
+        self.end = 0
+        self.error = None
+        self.token = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        if exc_type is asyncio.CancelledError:
+            self.attributes["cancelled"] = True
+        elif exc is not None:
+            self.error = repr(exc)
+        current_span.reset(self.token)
+        self.trace.tracer.exporter.export(self)
+        return False
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start / 1e9,
+            "duration_ms": round((self.end - self.start) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Tracer:
+    def __init__(self, sample_rate: float, exporter, max_spans: int):
+        """Creates spans for the phases of a request and hands them to an exporter when they end.
+        attributes:
+            sample_rate: share of requests traced, requests with a sampled W3C traceparent header are always traced.
+            exporter: LogExporter or OTLPExporter.
+            max_spans: spans recorded per trace, later ones are dropped so a long download stays cheap.
+
+        The current span is kept in a ContextVar, so spans opened in tasks created by a
+        traced request (read-ahead fetches, single-flight downloads) join its trace.
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.max_spans = max_spans
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes):
+        trace_id = parent_id = None
+        if traceparent:
+            parts = traceparent.split("-")
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and parts[3] == "01":
+                trace_id, parent_id = parts[1], parts[2]
+        if trace_id is None:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return NOOP_SPAN
+            trace_id = secrets.token_hex(16)
+        trace = Trace(self, trace_id)
+        trace.spans += 1
+        return Span(trace, name, parent_id, attributes)
+
+    def span(self, name: str, **attributes):
+        parent = current_span.get()
+        if parent is None or parent.trace.spans >= self.max_spans:
+            return NOOP_SPAN
+        parent.trace.spans += 1
+        return Span(parent.trace, name, parent.span_id, attributes)
+
+
+class LogExporter:
+    """Writes every finished span as one JSON line to the TechVJ.tracing logger."""
+
+    def __init__(self):
+        self.logger = logging.getLogger("TechVJ.tracing")
+
+    def export(self, span: Span) -> None:
+        self.logger.info(json.dumps(span.as_dict(), default=str))
+
+
+class OTLPExporter:
+    batch_size = 512
+    flush_interval = 5
+    max_queue = 8192
+
+    def __init__(self, endpoint: str):
+        """Sends spans to an OpenTelemetry collector with OTLP/HTTP JSON, in batches from a background task.
+        Spans are dropped when the collector can't keep up, tracing never slows down a stream.
+        """
+        self.endpoint = endpoint
+        self.queue: List[Span] = []
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def export(self, span: Span) -> None:
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append(span)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self) -> None:
+        while self.queue:
+            await asyncio.sleep(self.flush_interval)
+            while self.queue:
+                batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+                await self.send(batch)
+
+    async def send(self, batch: List[Span]) -> None:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [otlp_attribute("service.name", "TechVJ")]},
+                "scopeSpans": [{
+                    "scope": {"name": "TechVJ.tracing"},
+                    "spans": [otlp_span(span) for span in batch],
+                }],
+            }]
+        }
+        try:
+            async with self.session.post(self.endpoint, json=payload) as response:
+                if response.status >= 400:
+                    logging.debug(f"Trace collector answered {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.debug(f"Couldn't export {len(batch)} spans: {e!r}")
+
+
+def otlp_attribute(key: str, value) -> Dict[str, object]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def otlp_span(span: Span) -> Dict[str, object]:
+    data = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 2 if span.parent_id is None else 1,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end),
+        "attributes": [otlp_attribute(k, v) for k, v in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+@web.middleware
+async def trace_middleware(request: web.Request, handler):
+    """Opens the root span of a sampled request, the phases below it are traced where they happen."""
+    resource = request.match_info.route.resource
+    with tracer.start_trace(
+        f"{request.method} {resource.canonical if resource else request.path}",
+        traceparent=request.headers.get("traceparent"),
+        path=request.path,
+        remote=request.remote,
+    ) as span:
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            span.set_attribute("status", e.status)
+            raise
+        span.set_attribute("status", response.status)
+        return response
+
+
+tracer = Tracer(
+    TRACE_SAMPLE_RATE,
+    OTLPExporter(TRACE_OTLP_ENDPOINT) if TRACE_EXPORTER == "otlp" else LogExporter(),
+    TRACE_MAX_SPANS,
+)
@@ -0,0 +1,253 @@
+# Streaming benchmark with a fake MTProto backend.
+#
+# Runs the real aiohttp app and streaming stack (scheduler, ByteStreamer, read-ahead,
+# chunk cache, bandwidth shaper) against a stand-in media session that serves
+# synthetic bytes, so prefetching and caching changes can be measured without Telegram.
+#
+#   python3 benchmark.py --concurrency 32 --requests 256 --latency 80 --jitter 20
+#
+# Reports throughput, time to first byte percentiles and memory per connection.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark media_streamer against a fake MTProto backend")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent HTTP requests")
+    parser.add_argument("--requests", type=int, default=64, help="total HTTP requests")
+    parser.add_argument("--file-size", type=float, default=256, help="size of the synthetic file in MB")
+    parser.add_argument("--range-size", type=float, default=16, help="bytes per request in MB, 0 requests the whole file")
+    parser.add_argument("--files", type=int, default=1, help="number of distinct synthetic files")
+    parser.add_argument("--latency", type=float, default=50, help="GetFile latency in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="random extra GetFile latency in ms")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a GetFile raising FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=1, help="seconds carried by injected FloodWaits")
+    parser.add_argument("--prefetch", type=int, help="override PREFETCH_CHUNKS")
+    parser.add_argument("--cache", type=int, default=0, help="chunk cache size in MB, 0 disables it")
+    parser.add_argument("--verify", action="store_true", help="check every received byte")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+
+# configure the app before it is imported, config.py reads the environment once
+if ARGS.prefetch is not None:
+    os.environ["PREFETCH_CHUNKS"] = str(ARGS.prefetch)
+os.environ["CHUNK_CACHE_SIZE"] = str(ARGS.cache)
+os.environ["CHUNK_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-chunks-")
+os.environ["PREWARM_MEDIA_SESSIONS"] = "False"
+os.environ["MAX_STREAMS_PER_IP"] = "0"
+
+import aiohttp
+from aiohttp import web
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+from TechVJ.bot import multi_clients, work_loads
+from TechVJ.server import web_server
+from TechVJ.utils.file_cache import file_cache
+from TechVJ.utils.session_pool import session_pools
+
+PATTERN_SIZE = 251
+PATTERN = bytes(range(PATTERN_SIZE)) * (1024 * 1024 // PATTERN_SIZE + 2)
+
+
+def secure_hash(id: int) -> str:
+    return f"b{id:05d}"
+
+
+def synthetic_bytes(offset: int, length: int) -> bytes:
+    start = offset % PATTERN_SIZE
+    return PATTERN[start:start + length]
+
+
+class FakeSession:
+    """Stands in for a pyrogram media Session and answers GetFile with synthetic bytes."""
+
+    def __init__(self, file_sizes):
+        self.file_sizes = file_sizes
+        self.calls = 0
+        self.flood_waits = 0
+
+    async def send(self, query, *args, **kwargs):
+        self.calls += 1
+        await asyncio.sleep((ARGS.latency + random.uniform(0, ARGS.jitter)) / 1000)
+        if ARGS.flood_rate and random.random() < ARGS.flood_rate:
+            self.flood_waits += 1
+            raise FloodWait(value=ARGS.flood_wait)
+        file_size = self.file_sizes[query.location.id]
+        length = max(0, min(query.limit, file_size - query.offset))
+        return raw.types.upload.File(
+            type=raw.types.storage.FileUnknown(),
+            mtime=0,
+            bytes=synthetic_bytes(query.offset, length),
+        )
+
+
+class FakePool:
+    def __init__(self, session):
+        self.session = session
+
+    async def get(self, dc_id):
+        return self.session
+
+
+class FakeClient:
+    name = "bench"
+
+    def __init__(self):
+        self.media_sessions = {}
+
+
+def install_backend(file_size: int):
+    client = FakeClient()
+    multi_clients.clear()
+    work_loads.clear()
+    multi_clients[0] = client
+    work_loads[0] = 0
+
+    file_sizes = {}
+    for id in range(1, ARGS.files + 1):
+        file_id = FileId(
+            file_type=FileType.DOCUMENT,
+            dc_id=2,
+            media_id=id,
+            access_hash=0,
+            file_reference=b"",
+        )
+        file_id.file_size = file_size
+        file_id.mime_type = "video/mp4"
+        file_id.file_name = f"bench-{id}.mp4"
+        file_id.unique_id = f"{secure_hash(id)}bench"
+        file_id.duration = 0
+        file_sizes[id] = file_size
+        file_cache.set(file_cache.make_key(client, id), file_id, time.time() + 86400)
+
+    session = FakeSession(file_sizes)
+    session_pools[client.name] = FakePool(session)
+    return session
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def one_request(http, base_url, file_size, range_size, results):
+    id = random.randint(1, ARGS.files)
+    headers = {}
+    from_bytes, until_bytes = 0, file_size - 1
+    if range_size and range_size < file_size:
+        from_bytes = random.randrange(0, file_size - range_size)
+        until_bytes = from_bytes + range_size - 1
+        headers["Range"] = f"bytes={from_bytes}-{until_bytes}"
+
+    start = time.perf_counter()
+    ttfb = None
+    received = 0
+    ok = True
+    async with http.get(f"{base_url}/{id}?hash={secure_hash(id)}", headers=headers) as response:
+        async for data in response.content.iter_any():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            if ARGS.verify and data != synthetic_bytes(from_bytes + received, len(data)):
+                ok = False
+            received += len(data)
+        expected = until_bytes - from_bytes + 1
+        results.append({
+            "status": response.status,
+            "ttfb": ttfb if ttfb is not None else time.perf_counter() - start,
+            "elapsed": time.perf_counter() - start,
+            "bytes": received,
+            "complete": received == expected and ok,
+        })
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def main():
+    file_size = int(ARGS.file_size * 1024 * 1024)
+    range_size = int(ARGS.range_size * 1024 * 1024)
+    session = install_backend(file_size)
+
+    runner = web.AppRunner(await web_server())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    base_url = f"http://{host}:{port}"
+
+    results = []
+    queue = asyncio.Queue()
+    for _ in range(ARGS.requests):
+        queue.put_nowait(None)
+
+    peak_rss = baseline_rss = rss_bytes()
+    sampling = True
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while sampling:
+            peak_rss = max(peak_rss, rss_bytes())
+            await asyncio.sleep(0.05)
+
+    async def worker(http):
+        while not queue.empty():
+            queue.get_nowait()
+            try:
+                await one_request(http, base_url, file_size, range_size, results)
+            except aiohttp.ClientError as e:
+                results.append({"status": 0, "ttfb": 0, "elapsed": 0, "bytes": 0, "complete": False, "error": repr(e)})
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=ARGS.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as http:
+        await asyncio.gather(*[worker(http) for _ in range(ARGS.concurrency)])
+    duration = time.perf_counter() - started
+    sampling = False
+    await sampler
+    await runner.cleanup()
+
+    total_bytes = sum(r["bytes"] for r in results)
+    ttfbs = [r["ttfb"] for r in results if r["status"] in (200, 206)]
+    report = {
+        "requests": len(results),
+        "complete": sum(r["complete"] for r in results),
+        "statuses": {str(s): sum(r["status"] == s for r in results) for s in sorted({r["status"] for r in results})},
+        "duration_s": round(duration, 3),
+        "throughput_mb_s": round(total_bytes / duration / 1024 / 1024, 2),
+        "ttfb_p50_ms": round(percentile(ttfbs, 50) * 1000, 1),
+        "ttfb_p99_ms": round(percentile(ttfbs, 99) * 1000, 1),
+        "ttfb_mean_ms": round(statistics.mean(ttfbs) * 1000, 1) if ttfbs else 0.0,
+        "memory_per_connection_kb": round((peak_rss - baseline_rss) / ARGS.concurrency / 1024, 1),
+        "getfile_calls": session.calls,
+        "flood_waits": session.flood_waits,
+    }
+    if ARGS.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
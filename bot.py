@@ -27,7 +27,7 @@ logging.getLogger("pyrogram").setLevel(logging.ERROR)
 
 from pyrogram import Client, __version__
 from pyrogram.raw.all import layer
-from config import LOG_CHANNEL, ON_HEROKU, CLONE_MODE, PORT
+from config import LOG_CHANNEL, ON_HEROKU, CLONE_MODE, PORT, PREWARM_MEDIA_SESSIONS
 from typing import Union, Optional, AsyncGenerator
 from pyrogram import types
 from Script import script 
@@ -43,9 +43,13 @@ from TechVJ.server import web_server
 import asyncio
 from pyrogram import idle
 from plugins.clone import restart_bots
-from TechVJ.bot import StreamBot
+from TechVJ.bot import StreamBot, multi_clients
 from TechVJ.utils.keepalive import ping_server
 from TechVJ.bot.clients import initialize_clients
+from TechVJ.utils.session_pool import warm_up_media_sessions
+from plugins.dbusers import db
+from TechVJ.utils.chat_ingest import chat_ingest
+from TechVJ.utils.media_proxy import media_resolver
 
 # Don't Remove Credit Tg - @VJ_Botz
 # Subscribe YouTube Channel For Amazing Bot https://youtube.com/@Tech_VJ
@@ -68,6 +72,9 @@ async def start():
     bot_info = await StreamBot.get_me()
     StreamBot.username = bot_info.username
     await initialize_clients()
+    await db.ensure_indexes()
+    if PREWARM_MEDIA_SESSIONS:
+        asyncio.create_task(warm_up_media_sessions(multi_clients))
     for name in files:
         with open(name) as a:
             patt = Path(a.name)
@@ -95,6 +102,9 @@ async def start():
         await restart_bots()
     print("Bot Started Powered By @VJ_Botz")
     await idle()
+    # write the chat messages still waiting in the queue before exiting
+    await chat_ingest.close()
+    await media_resolver.close()
 
 # Don't Remove Credit Tg - @VJ_Botz
 # Subscribe YouTube Channel For Amazing Bot https://youtube.com/@Tech_VJ
@@ -115,6 +115,48 @@ STREAM_MODE = bool(environ.get('STREAM_MODE', True)) # Set True or False
 MULTI_CLIENT = False
 SLEEP_THRESHOLD = int(environ.get('SLEEP_THRESHOLD', '60'))
 PING_INTERVAL = int(environ.get("PING_INTERVAL", "1200"))  # 20 minutes
+PREFETCH_CHUNKS = int(environ.get("PREFETCH_CHUNKS", "4"))  # GetFile requests kept in flight per download
+CLIENT_SCHEDULER = environ.get("CLIENT_SCHEDULER", "affinity")  # affinity or least_loaded
+STRIPED_DOWNLOAD = is_enabled((environ.get('STRIPED_DOWNLOAD', "False")), False)  # Fetch one download across all clients
+STRIPE_INFLIGHT = int(environ.get("STRIPE_INFLIGHT", "2"))  # GetFile calls in flight per client for each striped download
+METADATA_CACHE_SIZE = int(environ.get("METADATA_CACHE_SIZE", "10000"))  # File properties kept in memory
+METADATA_CACHE_TTL = int(environ.get("METADATA_CACHE_TTL", "1800"))  # Seconds before file properties are resolved again
+METADATA_CACHE_BACKEND = environ.get("METADATA_CACHE_BACKEND", "memory")  # memory, mongodb or sqlite
+METADATA_CACHE_SQLITE = environ.get("METADATA_CACHE_SQLITE", "cache/file_meta.db")
+NEGATIVE_CACHE_TTL = int(environ.get("NEGATIVE_CACHE_TTL", "300"))  # Seconds a message id without media is rejected without asking Telegram
+MESSAGE_BATCH_DELAY = int(environ.get("MESSAGE_BATCH_DELAY", "10"))  # Milliseconds to collect message lookups for one get_messages call
+PREWARM_MEDIA_SESSIONS = is_enabled((environ.get('PREWARM_MEDIA_SESSIONS', "True")), True)  # Create media sessions for every DC at startup
+MEDIA_SESSIONS_PER_DC = int(environ.get("MEDIA_SESSIONS_PER_DC", "2"))
+MEDIA_SESSION_CHECK_INTERVAL = int(environ.get("MEDIA_SESSION_CHECK_INTERVAL", "300"))  # Seconds between media session health checks
+STREAM_WRITE_HIGH = int(environ.get("STREAM_WRITE_HIGH", "1024"))  # KiB buffered per connection before writes wait for the client
+STREAM_WRITE_LOW = int(environ.get("STREAM_WRITE_LOW", "256"))  # KiB the buffer drains to before writing resumes
+ADAPTIVE_CHUNKS = is_enabled((environ.get('ADAPTIVE_CHUNKS', "True")), True)  # Size GetFile requests to the requested range
+HLS_MODE = is_enabled((environ.get('HLS_MODE', "False")), False)  # Play /watch pages through a segmented HLS playlist
+HLS_SEGMENT_SIZE = int(environ.get("HLS_SEGMENT_SIZE", "2"))  # Segment size in MB
+GLOBAL_RATE_LIMIT = float(environ.get("GLOBAL_RATE_LIMIT", "0"))  # MB/s for all streams, 0 disables
+IP_RATE_LIMIT = float(environ.get("IP_RATE_LIMIT", "0"))  # MB/s per client IP, 0 disables
+FILE_RATE_LIMIT = float(environ.get("FILE_RATE_LIMIT", "0"))  # MB/s per file, 0 disables
+MAX_STREAMS = int(environ.get("MAX_STREAMS", "0"))  # Concurrent streams, 0 disables
+MAX_STREAMS_PER_IP = int(environ.get("MAX_STREAMS_PER_IP", "0"))  # Concurrent streams per client IP, 0 disables
+TRUSTED_PROXIES = int(environ.get("TRUSTED_PROXIES", "0"))  # Reverse proxies in front of the server (1 on Heroku), the client IP is then read from X-Forwarded-For
+CHUNK_RETRIES = int(environ.get("CHUNK_RETRIES", "3"))  # Retries of a failed GetFile before the download moves to another client
+CHUNK_RETRY_BACKOFF = float(environ.get("CHUNK_RETRY_BACKOFF", "0.5"))  # Seconds before the first retry, doubled on every attempt
+MAX_FLOOD_WAIT = int(environ.get("MAX_FLOOD_WAIT", "10"))  # Longest FloodWait in seconds waited out mid-stream when no other client is free
+TRACE_SAMPLE_RATE = float(environ.get("TRACE_SAMPLE_RATE", "0"))  # Share of requests traced, 0 disables tracing
+TRACE_EXPORTER = environ.get("TRACE_EXPORTER", "log")  # log or otlp
+TRACE_OTLP_ENDPOINT = environ.get("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")  # OTLP/HTTP collector for TRACE_EXPORTER=otlp
+TRACE_MAX_SPANS = int(environ.get("TRACE_MAX_SPANS", "1000"))  # Spans kept per traced request
+STREAM_SECRET = environ.get("STREAM_SECRET", "")  # HMAC key for stream links, derived from BOT_TOKEN when empty
+STREAM_TOKEN_TTL = int(environ.get("STREAM_TOKEN_TTL", "86400"))  # Seconds a stream/download link stays valid
+STREAM_TOKEN_BIND_IP = is_enabled((environ.get('STREAM_TOKEN_BIND_IP', "False")), False)  # Bind links issued by the watch page to the viewer's IP
+LEGACY_HASH_LINKS = is_enabled((environ.get('LEGACY_HASH_LINKS', "True")), True)  # Keep accepting old ?hash= links
+CHAT_WRITE_QUEUE = int(environ.get("CHAT_WRITE_QUEUE", "10000"))  # Chat messages waiting to be written before new ones wait
+CHAT_WRITE_BATCH = int(environ.get("CHAT_WRITE_BATCH", "100"))  # Chat messages written per batch
+CHAT_WRITE_DELAY = int(environ.get("CHAT_WRITE_DELAY", "50"))  # Milliseconds to collect chat messages into one batch
+MEDIA_URL_TTL = int(environ.get("MEDIA_URL_TTL", "3000"))  # Seconds a resolved Bot API file path is reused by the dashboard media proxy
+MEDIA_PROXY_CONNECTIONS = int(environ.get("MEDIA_PROXY_CONNECTIONS", "20"))  # Pooled connections to the Bot API shared by the media proxy
+CHUNK_CACHE_DIR = environ.get("CHUNK_CACHE_DIR", "cache/chunks")
+CHUNK_CACHE_SIZE = int(environ.get("CHUNK_CACHE_SIZE", "1024"))  # Size in MB, 0 disables the chunk cache
 if 'DYNO' in environ:
     ON_HEROKU = True
 else:
@@ -0,0 +1,146 @@
+# Moves chat history out of the per-user `chats` arrays.
+#
+# Every chat_col document that still has a `chats` array gets its messages copied into
+# chat_messages (one document per message), its summary fields (last_update, last_message,
+# message_count, unread_count, last_read_id) filled in and the array removed. Documents are streamed in batches, so
+# the migration runs against a live database without loading the collection into memory.
+#
+#   python3 migrate_chats.py --batch-size 200
+#   python3 migrate_chats.py --dry-run
+#
+# The migration can be interrupted and run again, a user's migrated messages are replaced
+# until their `chats` array is gone.
+
+import sys
+import struct
+import asyncio
+import argparse
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, InsertOne
+from plugins.dbusers import db
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert chat_col documents to per-message storage")
+    parser.add_argument("--batch-size", type=int, default=100, help="chat documents read per batch")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="keep the second copy of incoming messages that were stored twice")
+    parser.add_argument("--dry-run", action="store_true", help="count what would be migrated without writing")
+    return parser.parse_args()
+
+
+def is_duplicate(previous, chat) -> bool:
+    """
+    Incoming messages used to be pushed twice, once by add_chat (with is_read) and once by
+    notify_admin_new_message (with from_admin), within the same second.
+    """
+    return (
+        previous is not None
+        and previous.get("message") == chat.get("message")
+        and previous.get("message_type") == chat.get("message_type")
+        and previous.get("timestamp") == chat.get("timestamp")
+        and ("from_admin" in previous) != ("from_admin" in chat)
+    )
+
+
+def message_object_id(timestamp, fallback: int) -> ObjectId:
+    """
+    Returns an ObjectId dated at the message's timestamp, messages are ordered by _id and
+    migrated ones must sort before everything stored since the new schema went live.
+    """
+    seconds = fallback
+    if isinstance(timestamp, datetime):
+        seconds = int(timestamp.timestamp())
+    elif isinstance(timestamp, str):
+        try:
+            seconds = int(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+                          .replace(tzinfo=ZoneInfo("Asia/Yangon")).timestamp())
+        except ValueError:
+            pass
+    # a fresh ObjectId's process and counter bytes keep ids unique and in insertion order
+    return ObjectId(struct.pack(">I", max(seconds, fallback)) + ObjectId().binary[4:])
+
+
+def convert(user_id, chats, keep_duplicates, created_at):
+    messages = []
+    previous = None
+    seconds = created_at
+    for index, chat in enumerate(chats):
+        if not keep_duplicates and is_duplicate(previous, chat):
+            # keep the copy's from_admin flag, the first one carried is_read
+            messages[-1]["from_admin"] = bool(chat.get("from_admin", messages[-1]["from_admin"]))
+            previous = None
+            continue
+        from_admin = bool(chat.get("from_admin", False))
+        _id = message_object_id(chat.get("timestamp"), seconds)
+        seconds = int(_id.generation_time.timestamp())
+        messages.append(dict(
+            _id=_id,
+            user_id=user_id,
+            message=chat.get("message"),
+            message_type=chat.get("message_type", "text"),
+            from_admin=from_admin,
+            is_read=bool(chat.get("is_read", from_admin)),
+            timestamp=chat.get("timestamp"),
+            legacy_index=index,
+        ))
+        previous = chat
+    return messages
+
+
+async def migrate_user(doc, args, totals):
+    user_id = int(doc["user_id"])
+    created_at = int(doc["_id"].generation_time.timestamp()) if isinstance(doc["_id"], ObjectId) else 0
+    messages = convert(user_id, doc.get("chats") or [], args.keep_duplicates, created_at)
+    totals["users"] += 1
+    totals["messages"] += len(messages)
+    totals["dropped"] += len(doc.get("chats") or []) - len(messages)
+    if args.dry_run:
+        return
+
+    # a previous run may have stopped after copying this user's messages
+    await db.message_col.delete_many({"user_id": user_id, "legacy_index": {"$exists": True}})
+    if messages:
+        await db.message_col.bulk_write([InsertOne(m) for m in messages], ordered=True)
+    # mark_read only moves last_read_id, so is_read is only meaningful on migrated messages
+    last_read = await db.message_col.find_one(
+        {"user_id": user_id, "legacy_index": {"$exists": True}, "is_read": True}, sort=[("_id", -1)]
+    )
+    read_ids = [_id for _id in (doc.get("last_read_id"), last_read and last_read["_id"]) if _id is not None]
+    unread = {"user_id": user_id, "from_admin": False}
+    summary = {}
+    if read_ids:
+        summary["last_read_id"] = max(read_ids)
+        unread["_id"] = {"$gt": summary["last_read_id"]}
+    summary["message_count"] = await db.message_col.count_documents({"user_id": user_id})
+    summary["unread_count"] = await db.message_col.count_documents(unread)
+    latest = await db.message_col.find_one({"user_id": user_id}, sort=[("_id", -1)])
+    if latest:
+        summary["last_message"] = latest
+        summary["last_update"] = latest.get("timestamp") or doc.get("last_update")
+    # the read cursor replaces the per-message flag, it would go stale after the first mark_read
+    await db.message_col.update_many(
+        {"user_id": user_id, "legacy_index": {"$exists": True}}, {"$unset": {"is_read": ""}}
+    )
+    await db.chat_col.update_one({"_id": doc["_id"]}, {"$set": summary, "$unset": {"chats": ""}})
+
+
+async def main():
+    args = parse_args()
+    # the bot builds the unique user_id index once conversations stored twice are migrated
+    await db.message_col.create_index([("user_id", ASCENDING), ("_id", DESCENDING)])
+    totals = {"users": 0, "messages": 0, "dropped": 0}
+    cursor = db.chat_col.find({"chats": {"$exists": True}}, batch_size=args.batch_size)
+    async for doc in cursor:
+        await migrate_user(doc, args, totals)
+        if totals["users"] % args.batch_size == 0:
+            print(f"{totals['users']} conversations, {totals['messages']} messages")
+    prefix = "would migrate" if args.dry_run else "migrated"
+    print(f"{prefix} {totals['users']} conversations, {totals['messages']} messages, "
+          f"{totals['dropped']} duplicates dropped")
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -18,30 +18,18 @@ import re
 import json
 import base64
 from urllib.parse import quote_plus
-from TechVJ.utils.file_properties import get_name, get_hash, get_media_file_size
+from TechVJ.utils.file_properties import get_name, get_media_file_size
+from TechVJ.utils.stream_token import make_token
 
 logger = logging.getLogger(__name__)
 
 BATCH_FILES = {}
 
-import httpx
 from datetime import datetime
-from TechVJ.server.stream_routes import notify_admin_new_message
+from TechVJ.utils.chat_ingest import chat_ingest
+from TechVJ.utils.media_proxy import media_url
 
 
-async def get_telegram_file_url(file_id: str):
-    try:
-        get_file_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={file_id}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(get_file_url)
-            res_data = response.json()
-            if res_data.get("ok"):
-                file_path = res_data["result"]["file_path"]
-                return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-    except Exception as e:
-        print(f"File URL Error: {e}")
-    return NoneNone
-
 def get_size(size):
     """Get size in readable format"""
 
@@ -74,7 +62,7 @@ async def start(client, message):
     
     # ---- Record the "start" command as chat ----
     start_text = "User started the bot."
-    await db.add_chat(
+    await chat_ingest.add(
         user_id=message.from_user.id,
         user_name=message.from_user.first_name,
         message=start_text,
@@ -194,8 +182,9 @@ async def start(client, message):
                     if info.video or info.document:
                         log_msg = info
                         fileName = {quote_plus(get_name(log_msg))}
-                        stream = f"{URL}watch/{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?hash={get_hash(log_msg)}"
-                        download = f"{URL}{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?hash={get_hash(log_msg)}"
+                        token = make_token(log_msg.id)
+                        stream = f"{URL}watch/{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?token={token}"
+                        download = f"{URL}{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?token={token}"
                         button = [[
                             InlineKeyboardButton("• ᴅᴏᴡɴʟᴏᴀᴅ •", url=download),
                             InlineKeyboardButton('• ᴡᴀᴛᴄʜ •', url=stream)
@@ -268,8 +257,9 @@ async def start(client, message):
                 if msg.video or msg.document:
                     log_msg = msg
                     fileName = {quote_plus(get_name(log_msg))}
-                    stream = f"{URL}watch/{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?hash={get_hash(log_msg)}"
-                    download = f"{URL}{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?hash={get_hash(log_msg)}"
+                    token = make_token(log_msg.id)
+                    stream = f"{URL}watch/{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?token={token}"
+                    download = f"{URL}{str(log_msg.id)}/{quote_plus(get_name(log_msg))}?token={token}"
                     button = [[
                         InlineKeyboardButton("• ᴅᴏᴡɴʟᴏᴀᴅ •", url=download),
                         InlineKeyboardButton('• ᴡᴀᴛᴄʜ •', url=stream)
@@ -346,6 +336,8 @@ async def save_user_message(client, message):
 
     content = ""
     msg_type = "text"
+    # media is stored by file_id, the dashboard resolves it through /tgchat/media when the message is shown
+    media = None
 
     # ---------- TEXT ----------
     if message.text:
@@ -355,26 +347,22 @@ async def save_user_message(client, message):
     # ---------- VIDEO ----------
     elif message.video:
         msg_type = "video"
-        file_id = message.video.file_id
-        content = await get_telegram_file_url(file_id)
+        media = message.video
 
     # ---------- PHOTO ----------
     elif message.photo:
         msg_type = "photo"
-        file_id = message.photo.file_id
-        content = await get_telegram_file_url(file_id)
+        media = message.photo
 
     # ---------- DOCUMENT ----------
     elif message.document:
         msg_type = "document"
-        file_id = message.document.file_id
-        content = await get_telegram_file_url(file_id)
+        media = message.document
 
     # ---------- ANIMATION (GIF) ----------
     elif message.animation:
         msg_type = "animation"
-        file_id = message.animation.file_id
-        content = await get_telegram_file_url(file_id)
+        media = message.animation
 
     # ---------- STICKER ----------
     elif message.sticker:
@@ -385,20 +373,16 @@ async def save_user_message(client, message):
         msg_type = "unknown"
         content = "Unsupported message"
 
-    # ---------- SAVE TO DATABASE ----------
-    await db.add_chat(
-        user_id=user_id,
-        user_name=user_name,
-        message=content,          # URL or text
-        message_type=msg_type
-    )
+    if media:
+        content = media_url(media.file_id)
 
-    # ---------- WEBSOCKET / ADMIN UPDATE ----------
-    await notify_admin_new_message(
+    # ---------- SAVE TO DATABASE + WEBSOCKET / ADMIN UPDATE ----------
+    await chat_ingest.add(
         user_id=user_id,
         user_name=user_name,
-        message_text=content,
-        msg_type=msg_type
+        message=content,          # dashboard media URL or text
+        message_type=msg_type,
+        media={"file_id": media.file_id, "file_unique_id": media.file_unique_id} if media else None
     )
 
 
@@ -1,13 +1,58 @@
+import logging
 import motor.motor_asyncio
 from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
 from config import DB_NAME, DB_URI
 from zoneinfo import ZoneInfo
+from TechVJ.utils.metrics import MongoCommandListener
 class Database:
     def __init__(self, uri, database_name):
-        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri, event_listeners=[MongoCommandListener()])
         self.db = self._client[database_name]
         self.users_col = self.db.users
+        # one summary document per conversation, the messages themselves live in message_col
         self.chat_col = self.db.chat
+        self.message_col = self.db.chat_messages
+
+    async def ensure_indexes(self):
+        await self.message_col.create_index([('user_id', ASCENDING), ('_id', DESCENDING)])
+        # add_chats relies on the unique index to stay idempotent, so duplicates are merged
+        # first and a failure to build it stops the bot
+        await self.merge_duplicate_chats()
+        await self.chat_col.create_index([('user_id', ASCENDING)], unique=True)
+        await self.chat_col.create_index([('last_update', DESCENDING), ('_id', DESCENDING)])
+
+    async def merge_duplicate_chats(self):
+        """
+        Collapses conversations stored more than once into their newest summary document,
+        with the counters recomputed from the messages.
+        """
+        cursor = self.chat_col.aggregate([
+            {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ], allowDiskUse=True)
+        async for group in cursor:
+            user_id = group['_id']
+            docs = await self.chat_col.find({'_id': {'$in': group['ids']}}).to_list(length=None)
+            if any('chats' in doc for doc in docs):
+                raise RuntimeError(f"User {user_id} has several conversations not migrated yet, run migrate_chats.py first")
+            docs.sort(key=lambda doc: (doc.get('last_message') or {}).get('_id') or doc['_id'])
+            keep = docs[-1]
+            update = {'message_count': await self.message_col.count_documents({'user_id': user_id})}
+            unread = {'user_id': user_id, 'from_admin': False}
+            read_ids = [doc['last_read_id'] for doc in docs if doc.get('last_read_id') is not None]
+            if read_ids:
+                update['last_read_id'] = max(read_ids)
+                unread['_id'] = {'$gt': update['last_read_id']}
+            update['unread_count'] = await self.message_col.count_documents(unread)
+            latest = await self.message_col.find_one({'user_id': user_id}, sort=[('_id', DESCENDING)])
+            if latest:
+                update.update(last_message=latest, last_update=latest['timestamp'])
+            await self.chat_col.update_one({'_id': keep['_id']}, {'$set': update})
+            await self.chat_col.delete_many({'_id': {'$in': [doc['_id'] for doc in docs[:-1]]}})
+            logging.warning(f"Merged {len(docs)} conversation documents of user {user_id}")
 
     # ---- Users functions ----
     def new_user(self, id, name):
@@ -38,32 +83,132 @@ class Database:
     async def delete_user(self, user_id):
         await self.users_col.delete_many({'id': int(user_id)})
         await self.chat_col.delete_many({'user_id': int(user_id)})
+        await self.message_col.delete_many({'user_id': int(user_id)})
 
     # ---- Chat functions ----
-    async def add_chat(self, user_id, user_name, message, message_type='text'):
+    def new_chat(self, user_id, message, message_type='text', from_admin=False, media=None):
         chat = dict(
+            # assigned here so the id is known (and ordered) before the write lands
+            _id=ObjectId(),
+            user_id=int(user_id),
             message=message,
             message_type=message_type,
-            is_read=False,
+            # read state isn't stored per message, an incoming message is read
+            # once the conversation's last_read_id reaches it
+            from_admin=from_admin,
             timestamp=datetime.now(ZoneInfo("Asia/Yangon")).strftime("%Y-%m-%d %H:%M:%S")
         )
-        # Push into single document per user
+        if media:
+            # file_id / file_unique_id of incoming media, `message` is then its dashboard URL
+            chat.update(media)
+        return chat
+
+    async def add_chats(self, chats):
+        """
+        Stores a batch of (chat, user_name) pairs: one insert_many for the messages and one
+        summary update per conversation, so neither write grows with the length of the history.
+        Retrying a batch is safe: the messages' ids were assigned by new_chat, and a summary
+        update only matches while the conversation's last_message is older than the batch, so a
+        conversation that already took the batch turns the upsert into an ignored duplicate key.
+        """
+        try:
+            await self.message_col.insert_many([chat for chat, _ in chats], ordered=False)
+        except BulkWriteError as e:
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        summaries = {}
+        for chat, user_name in chats:
+            update = summaries.setdefault(chat['user_id'], {
+                '$set': {},
+                '$setOnInsert': {'user_id': chat['user_id']},
+                '$inc': {'message_count': 0, 'unread_count': 0},
+            })
+            update['$set'].update(last_update=chat['timestamp'], last_message=chat)
+            if user_name and not chat['from_admin']:
+                update['$set']['user_name'] = user_name
+            update['$inc']['message_count'] += 1
+            update['$inc']['unread_count'] += 0 if chat['from_admin'] else 1
+        try:
+            await self.chat_col.bulk_write(
+                [
+                    UpdateOne(
+                        {'user_id': user_id, 'last_message._id': {'$not': {'$gte': update['$set']['last_message']['_id']}}},
+                        update,
+                        upsert=True
+                    )
+                    for user_id, update in summaries.items()
+                ],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+
+    async def mark_read(self, user_id):
+        """
+        Moves the conversation's read cursor to its last message and clears the unread counter.
+        A pipeline update reads last_message and writes both fields in one atomic step,
+        so a message arriving at the same moment is either counted as read or stays unread.
+        """
         await self.chat_col.update_one(
-            {'user_id': int(user_id)},                   # filter by user_id
-            {'$setOnInsert': {'user_name': user_name, 'user_id': int(user_id)},
-             '$push': {'chats': chat}},                 # push chat into chats array
-            upsert=True                                  # insert if not exist
+            {'user_id': int(user_id)},
+            [{'$set': {'last_read_id': '$last_message._id', 'unread_count': 0}}]
         )
 
-    async def get_user_chats(self, user_id, limit=50):
+    async def get_user_chats(self, user_id, limit=50, before=None):
+        """
+        Get last `limit` chats of a user, oldest first.
+        With `before` (a message _id) the page ends right before that message.
+        """
+        query = {'user_id': int(user_id)}
+        if before is not None:
+            query['_id'] = {'$lt': before}
+        cursor = self.message_col.find(query).sort('_id', DESCENDING).limit(limit)
+        chats = await cursor.to_list(length=limit)
+        chats.reverse()
+        return chats
+
+    async def get_recent_chats(self, users=100, limit=50):
+        """
+        Get the `users` most recently active conversations with their last `limit` chats, oldest first.
+        One aggregation, the $lookup runs on the (user_id, _id) index for each conversation.
+        """
+        cursor = self.chat_col.aggregate([
+            {'$sort': {'last_update': DESCENDING, '_id': DESCENDING}},
+            {'$limit': users},
+            {'$lookup': {
+                'from': self.message_col.name,
+                'let': {'user_id': '$user_id'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$user_id', '$$user_id']}}},
+                    {'$sort': {'_id': DESCENDING}},
+                    {'$limit': limit},
+                ],
+                'as': 'chats',
+            }},
+            {'$project': {'user_id': 1, 'user_name': 1, 'chats': 1}},
+        ])
+        conversations = await cursor.to_list(length=users)
+        for conversation in conversations:
+            conversation['chats'].reverse()
+        return conversations
+
+    async def get_inbox(self, limit=50, before=None):
         """
-        Get last `limit` chats of a user (from chats array)
+        Get a page of conversations, most recently active first.
+        `before` is the (last_update, _id) of the last conversation on the previous page,
+        the sort matches the (last_update, _id) index so every page is a range scan.
         """
-        user_doc = await self.chat_col.find_one({'user_id': int(user_id)})
-        if not user_doc or 'chats' not in user_doc:
-            return []
-        # Return last `limit` chats
-        return user_doc['chats'][-limit:]
+        query = {}
+        if before is not None:
+            last_update, _id = before
+            query = {'$or': [
+                {'last_update': {'$lt': last_update}},
+                {'last_update': last_update, '_id': {'$lt': _id}},
+            ]}
+        projection = {'user_id': 1, 'user_name': 1, 'last_update': 1, 'last_message': 1, 'unread_count': 1, 'last_read_id': 1}
+        cursor = self.chat_col.find(query, projection).sort([('last_update', DESCENDING), ('_id', DESCENDING)]).limit(limit)
+        return await cursor.to_list(length=limit)
 
     async def total_chats_count(self):
         return await self.chat_col.count_documents({})